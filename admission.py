@@ -0,0 +1,172 @@
+# admission.py
+
+import fcntl
+import logging
+import os
+import threading
+import time
+from flask import current_app, g, jsonify, request
+
+# Контроль допуска для дорогих маршрутов (холодный /get-place-info,
+# /get-recommendations). Каждый класс запросов ограничен по числу одновременных
+# выполнений в воркере (семафор) и на хосте (слоты-файлы с flock, общие для всех
+# воркеров). Лишние запросы ждут в очереди не дольше ADMISSION_QUEUE_TIMEOUT и
+# получают быстрый отказ (503 + Retry-After или деградированный ответ), чтобы
+# дешевые маршруты не стояли в очереди за вызовами LLM.
+
+STATIC = 'static'
+AUTH = 'auth'
+CACHE_HIT = 'cache_hit'
+COLD_PLACE_INFO = 'cold_place_info'
+RECOMMENDATIONS = 'recommendations'
+OTHER = 'other'
+
+_ENDPOINT_CLASSES = {
+    'static': STATIC,
+    'get_place_info_route': CACHE_HIT,  # Уточняется маршрутом после проверки кэша
+    'get_recommendations_route': RECOMMENDATIONS,
+}
+
+
+class AdmissionRejected(Exception):
+    """Запрос отклонен контролем допуска."""
+
+    def __init__(self, request_class, retry_after, reason):
+        super().__init__(f"{request_class}: {reason}")
+        self.request_class = request_class
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _ClassLimiter:
+    """Ограничение одного класса запросов в текущем процессе и на хосте."""
+
+    def __init__(self, name, worker_limit, global_limit, max_queue, slots_dir):
+        self.name = name
+        self.global_limit = global_limit
+        self.max_queue = max_queue
+        self.slots_dir = slots_dir
+        self._semaphore = threading.BoundedSemaphore(worker_limit)
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def _acquire_global_slot(self, deadline):
+        """Пытается занять один из слотов хоста до дедлайна; возвращает открытый файл."""
+        while True:
+            for index in range(self.global_limit):
+                slot_file = open(os.path.join(self.slots_dir, f"{self.name}.{index}.lock"), 'a')
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return slot_file
+                except BlockingIOError:
+                    slot_file.close()
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.01)
+
+    def acquire(self, queue_timeout, retry_after):
+        deadline = time.monotonic() + queue_timeout
+        # В очередь (и в лимит max_queue) попадают только запросы, которым не хватило слота
+        if not self._semaphore.acquire(blocking=False):
+            with self._lock:
+                if self._waiting >= self.max_queue:
+                    raise AdmissionRejected(self.name, retry_after, 'очередь воркера переполнена')
+                self._waiting += 1
+            try:
+                acquired = self._semaphore.acquire(timeout=queue_timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            if not acquired:
+                raise AdmissionRejected(self.name, retry_after, 'истек срок ожидания в очереди воркера')
+
+        if not self.global_limit:
+            return None
+        slot_file = self._acquire_global_slot(deadline)
+        if slot_file is None:
+            self._semaphore.release()
+            raise AdmissionRejected(self.name, retry_after, 'все слоты хоста заняты')
+        return slot_file
+
+    def release(self, slot_file):
+        if slot_file is not None:
+            slot_file.close()  # Закрытие файла снимает flock
+        self._semaphore.release()
+
+
+class AdmissionController:
+    """Набор ограничителей для классов запросов приложения."""
+
+    def __init__(self, app):
+        config = app.config
+        slots_dir = config['ADMISSION_DIR'] or os.path.join(app.instance_path, 'admission')
+        os.makedirs(slots_dir, exist_ok=True)
+        self.queue_timeout = config['ADMISSION_QUEUE_TIMEOUT']
+        self.retry_after = config['ADMISSION_RETRY_AFTER']
+        global_limits = config['ADMISSION_GLOBAL_LIMITS']
+        max_queue = config['ADMISSION_MAX_QUEUE']
+        self.limiters = {
+            name: _ClassLimiter(
+                name, worker_limit, global_limits.get(name, 0), max_queue.get(name, worker_limit * 4),
+                slots_dir
+            )
+            for name, worker_limit in config['ADMISSION_WORKER_LIMITS'].items()
+        }
+
+    def acquire(self, request_class):
+        limiter = self.limiters.get(request_class)
+        if limiter is None:
+            return None
+        return limiter, limiter.acquire(self.queue_timeout, self.retry_after)
+
+
+def classify_request():
+    """Определяет класс запроса по маршруту (до выполнения обработчика)."""
+    if request.blueprint == 'auth':
+        return AUTH
+    return _ENDPOINT_CLASSES.get(request.endpoint, OTHER)
+
+
+def admit(request_class):
+    """Допускает запрос класса request_class или вызывает AdmissionRejected.
+
+    Занятый слот освобождается автоматически в конце запроса.
+    """
+    g.request_class = request_class
+    controller = current_app.extensions.get('admission')
+    if controller is None:
+        return
+    ticket = controller.acquire(request_class)
+    if ticket is not None:
+        g.setdefault('admission_tickets', []).append(ticket)
+
+
+def _classify():
+    g.request_class = classify_request()
+
+
+def _release_tickets(exc=None):
+    for limiter, slot_file in g.pop('admission_tickets', []):
+        limiter.release(slot_file)
+
+
+def _handle_rejected(error):
+    logging.warning(f"Запрос {request.path} отклонен контролем допуска: {error}")
+    response = jsonify({
+        "error": "Сервис перегружен, попробуйте позже",
+        "details": error.reason,
+        "retry_after": error.retry_after,
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    response.cache_control.no_store = True
+    return response
+
+
+def init_app(app):
+    """Подключает классификацию запросов и контроль допуска."""
+    app.before_request(_classify)
+    app.register_error_handler(AdmissionRejected, _handle_rejected)
+    if app.config['ADMISSION_ENABLED']:
+        app.extensions['admission'] = AdmissionController(app)
+        app.teardown_request(_release_tickets)
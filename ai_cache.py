@@ -0,0 +1,63 @@
+# ai_cache.py
+
+import dataclasses
+import hashlib
+import json
+import re
+from flask import current_app
+from database import cache_json, get_cached_json
+
+# Кэш ответов Gemini поверх бэкенда кэша (см. cache_backends.py).
+# Два уровня ключей:
+#   llm:prompt:<hash> - нормализованный текст промпта + модель + параметры генерации;
+#   llm:place:<hash>  - распознанное место (OSM id или имя) + интересы + модель,
+#                       чтобы клики в разные точки одного POI делили одну генерацию.
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_prompt(prompt):
+    """Схлопывает пробельные символы (отступы f-строк не влияют на ключ)."""
+    return _WHITESPACE_RE.sub(' ', prompt).strip()
+
+
+def generation_config_fingerprint(generation_config):
+    """Стабильное строковое представление параметров генерации."""
+    if generation_config is None:
+        return ''
+    if dataclasses.is_dataclass(generation_config):
+        generation_config = dataclasses.asdict(generation_config)
+    return json.dumps(generation_config, sort_keys=True, default=str)
+
+
+def _digest(*parts):
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def prompt_cache_key(prompt, model_name, generation_config):
+    """Ключ кэша для конкретного промпта."""
+    return 'llm:prompt:' + _digest(
+        model_name, generation_config_fingerprint(generation_config), normalize_prompt(prompt)
+    )
+
+
+def place_cache_key(place_ref, interests, model_name, generation_config):
+    """Ключ кэша генерации для распознанного места и набора интересов."""
+    interests_part = ','.join(sorted({interest.lower() for interest in interests}))
+    return 'llm:place:' + _digest(
+        model_name, generation_config_fingerprint(generation_config),
+        normalize_prompt(place_ref).lower(), interests_part
+    )
+
+
+def get_cached_response(cache_key):
+    """Возвращает закэшированный ответ модели или None (кэш выключен / промах)."""
+    if not current_app.config['AI_CACHE_ENABLED']:
+        return None
+    return get_cached_json(cache_key, current_app.config['AI_CACHE_TTL'])
+
+
+def cache_response(cache_key, result):
+    """Сохраняет ответ модели в кэш."""
+    if current_app.config['AI_CACHE_ENABLED']:
+        cache_json(cache_key, result)
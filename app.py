@@ -1,6 +1,7 @@
 import os
 import json
 import logging
+import urllib.parse
 import datetime
 import functools
 import sqlite3
@@ -8,9 +9,8 @@ import google.generativeai as genai
 import wikipediaapi
 from dotenv import load_dotenv
 from duckduckgo_search import DDGS  # Добавляем для поиска через DuckDuckGo
-from geopy.exc import GeocoderServiceError, GeocoderTimedOut
+from geopy.exc import GeocoderServiceError, GeocoderTimedOut, GeocoderUnavailable
 from geopy.geocoders import Nominatim
-from werkzeug.security import check_password_hash, generate_password_hash
 from flask import (
     Flask, Blueprint, flash, g, jsonify, redirect, render_template, request,
     session, url_for, current_app
@@ -18,9 +18,26 @@ from flask import (
 from database import (
     init_app, get_db, close_db, init_db, get_cached_place_info, cache_place_info,
     get_user_by_id, get_user_by_username, add_user, get_all_interests,
-    get_user_interest_ids, update_user_interests, get_visited_places,
-    add_visited_place, get_user_interests
+    get_user_interest_ids, update_user_interests,
+    add_visited_place, get_user_interests, get_cached_user, invalidate_cached_user,
+    update_user_password_hash, schema_exists, index_place, place_cache_key, record_login,
+    get_stored_recommendations, store_recommendations
 )
+from passwords import PasswordHasherBusy, hash_password, needs_rehash, verify_password
+import scheme
+import http_cache
+import cache_backends
+import cache_snapshot
+import ai_cache
+import blob_store
+import traffic
+import viewport
+import profiling
+import recommendations
+import admission
+import hedging
+from profiling import stage
+from traffic import recorded_upstream
 
 # Загрузка переменных окружения из .env
 load_dotenv()
@@ -52,16 +69,49 @@ RECOMMENDATIONS_EXPECTED_JSON_FORMAT = """
 
 
 # --- Вспомогательные функции ---
+@recorded_upstream('nominatim')
 def get_location_details(latitude, longitude):
-    """Получает адрес и имя по координатам. Вызывает исключения при ошибках."""
+    """Получает адрес и имя по координатам. Вызывает исключения при ошибках.
+
+    Возвращает (place_name, address_info, osm_place), где osm_place - словарь
+    {'osm_ref': 'way/123', 'lat': ..., 'lng': ...} найденного объекта OSM
+    или None, если Nominatim не вернул его идентификатор.
+    """
     print(f"Геокодирование координат: {latitude}, {longitude}")
     geolocator = Nominatim(
         user_agent=current_app.config['GEOPY_USER_AGENT'],
         timeout=current_app.config['GEOPY_TIMEOUT']
     )
-    location = geolocator.reverse(
-        (latitude, longitude), exactly_one=True, language='en'
-    )
+    config = current_app.config
+
+    def reverse(locator):
+        return locator.reverse((latitude, longitude), exactly_one=True, language='en')
+
+    if config['GEOPY_HEDGE_ENABLED']:
+        # Второй запрос - к зеркалу (GEOPY_HEDGE_DOMAIN) или к тому же серверу
+        hedge_locator = geolocator
+        if config['GEOPY_HEDGE_DOMAIN']:
+            hedge_locator = Nominatim(
+                user_agent=config['GEOPY_USER_AGENT'],
+                timeout=config['GEOPY_TIMEOUT'],
+                domain=config['GEOPY_HEDGE_DOMAIN']
+            )
+        delay = hedging.hedge_delay(
+            'nominatim', config['GEOPY_HEDGE_DEFAULT_DELAY'], config['HEDGE_MIN_DELAY'], config['GEOPY_TIMEOUT']
+        )
+        try:
+            location, _ = hedging.hedged_call(
+                'nominatim',
+                [functools.partial(reverse, geolocator), functools.partial(reverse, hedge_locator)],
+                config['GEOPY_TIMEOUT'], delay, config['HEDGE_POOL_SIZE'],
+                retryable=lambda error: (
+                    isinstance(error, (GeocoderTimedOut, GeocoderUnavailable)) or hedging.default_retryable(error)
+                )
+            )
+        except hedging.HedgeTimeout as e:
+            raise GeocoderTimedOut(str(e))
+    else:
+        location = reverse(geolocator)
 
     if location and location.raw.get('address'):
         address_info = location.raw['address']
@@ -91,14 +141,23 @@ def get_location_details(latitude, longitude):
             if area and area != place_name:
                 place_name = f"{place_name}, {area}"
 
-        print(f"Geocoded Name: {place_name}")
-        return place_name, address_info
+        osm_place = None
+        if location.raw.get('osm_type') and location.raw.get('osm_id'):
+            osm_place = {
+                'osm_ref': f"{location.raw['osm_type']}/{location.raw['osm_id']}",
+                'lat': location.latitude,
+                'lng': location.longitude,
+            }
+
+        print(f"Geocoded Name: {place_name} ({osm_place['osm_ref'] if osm_place else 'без OSM id'})")
+        return place_name, address_info, osm_place
     else:
         print("Nominatim did not return a valid location or address.")
         default_place_name = f"Location at {latitude:.5f}, {longitude:.5f}"
-        return default_place_name, {}
+        return default_place_name, {}, None
 
 
+@recorded_upstream('wikipedia')
 def get_wikipedia_info(place_name, latitude, longitude):
     """Получает сводку из Википедии. Вызывает исключения при ошибках."""
     print(f"Поиск в Википедии для: '{place_name}' или координат {latitude}, {longitude}")
@@ -127,6 +186,7 @@ def get_wikipedia_info(place_name, latitude, longitude):
     return "Соответствующая статья в Википедии не найдена.", None
 
 
+@recorded_upstream('duckduckgo')
 def search_web(query):
     """Поиск в интернете через DuckDuckGo."""
     try:
@@ -141,20 +201,44 @@ def search_web(query):
         return []
 
 
-def call_ai_model(prompt, expected_json_format_description):
-    """Вызывает Google Gemini AI. Вызывает исключения при ошибках."""
-    print("\n--- Вызов Google Gemini AI ---")
-    model_to_use = current_app.ai_model
-    generation_config = current_app.generation_config
+def get_ai_model(model_name):
+    """Возвращает (и при первом обращении создает) клиент модели Gemini по имени."""
+    models = current_app.ai_models
+    if model_name not in models:
+        models[model_name] = genai.GenerativeModel(model_name)
+    return models[model_name]
 
-    if not model_to_use:
-        raise RuntimeError("Модель Google Gemini не инициализирована.")
 
-    print(f"Отправка запроса к модели: {model_to_use.model_name}")
+def ai_model_tiers():
+    """Уровни моделей в порядке вызова.
+
+    Каждый уровень - словарь: model, deadline (секунды), необязательные name,
+    hedge_model (модель для хедж-запроса, по умолчанию та же) и
+    upgrade_on_confidence (значения ai_confidence, при которых ответ уточняется
+    следующим уровнем). Без GOOGLE_GEMINI_MODEL_TIERS - один уровень GOOGLE_GEMINI_MODEL.
+    """
+    config = current_app.config
+    tiers = config['GOOGLE_GEMINI_MODEL_TIERS'] or [
+        {'name': 'primary', 'model': config['GOOGLE_GEMINI_MODEL'], 'deadline': config['AI_TIMEOUT']}
+    ]
+    return [dict(tier, name=tier.get('name') or f"tier{index}") for index, tier in enumerate(tiers)]
+
 
-    response = model_to_use.generate_content(
+def ai_model_chain():
+    """Идентификатор цепочки моделей для ключей кэша ответов."""
+    return '>'.join(tier['model'] for tier in ai_model_tiers())
+
+
+def _generate_json(model, prompt, generation_config, timeout):
+    """Один запрос к модели с таймаутом; возвращает распарсенный JSON.
+
+    Выполняется в потоке хеджирования, поэтому не обращается к контексту Flask.
+    """
+    print(f"Отправка запроса к модели: {model.model_name}")
+    response = model.generate_content(
         prompt,
         generation_config=generation_config,
+        request_options={'timeout': timeout},
     )
 
     raw_response_content = ""
@@ -166,17 +250,136 @@ def call_ai_model(prompt, expected_json_format_description):
         logging.error(f"Неожиданная структура ответа от Gemini: {response}")
         raise ValueError("Неожиданная структура ответа от Gemini")
 
-    print(f"Сырой ответ от Gemini (ожидается JSON): {raw_response_content[:500]}...")
+    print(f"Сырой ответ от {model.model_name} (ожидается JSON): {raw_response_content[:500]}...")
 
     try:
-        ai_result_json = json.loads(raw_response_content)
-        print("--- Ответ Gemini успешно распарсен как JSON ---")
-        return ai_result_json
+        return json.loads(raw_response_content)
     except json.JSONDecodeError as e:
-        logging.error(f"Ошибка парсинга JSON от Gemini: {e}")
+        logging.error(f"Ошибка парсинга JSON от {model.model_name}: {e}")
         raise
 
 
+def _ai_call_variant(prompt, expected_json_format_description, *args, **kwargs):
+    """Вид вызова AI для подмены записанными ответами - ожидаемый формат ответа."""
+    return expected_json_format_description
+
+
+@recorded_upstream('gemini', variant=_ai_call_variant)
+def call_ai_model(prompt, expected_json_format_description, use_cache=True):
+    """Вызывает Google Gemini AI. Вызывает исключения при ошибках.
+
+    Уровни моделей (ai_model_tiers) пробуются по очереди, каждый со своим
+    дедлайном и хедж-запросом; уровень, выдавший ответ, записывается в g.ai_served.
+    use_cache=False - без кэша по промпту (для ответов со своим хранилищем и сроком).
+    """
+    print("\n--- Вызов Google Gemini AI ---")
+    config = current_app.config
+    generation_config = current_app.generation_config
+
+    if not current_app.ai_models:
+        raise RuntimeError("Модель Google Gemini не инициализирована.")
+
+    cache_key = ai_cache.prompt_cache_key(prompt, ai_model_chain(), generation_config)
+    cached_result = ai_cache.get_cached_response(cache_key) if use_cache else None
+    if cached_result is not None:
+        print("--- Ответ Gemini взят из кэша по промпту ---")
+        g.ai_served = {'tier': 'cache', 'model': None, 'hedged': False}
+        return cached_result
+
+    tiers = ai_model_tiers()
+    served = None
+    last_error = None
+    for index, tier in enumerate(tiers):
+        model_names = [tier['model']]
+        if config['AI_HEDGE_ENABLED']:
+            model_names.append(tier.get('hedge_model') or tier['model'])
+        attempts = [
+            functools.partial(_generate_json, get_ai_model(name), prompt, generation_config, tier['deadline'])
+            for name in model_names
+        ]
+        latency_name = f"gemini:{tier['model']}"
+        delay = hedging.hedge_delay(
+            latency_name, config['AI_HEDGE_DEFAULT_DELAY'], config['HEDGE_MIN_DELAY'], tier['deadline']
+        )
+        try:
+            result, attempt = hedging.hedged_call(
+                latency_name, attempts, tier['deadline'], delay, config['HEDGE_POOL_SIZE']
+            )
+        except Exception as e:
+            logging.warning(f"Уровень '{tier['name']}' ({tier['model']}) не ответил: {type(e).__name__}: {e}")
+            last_error = e
+            continue
+
+        served = ({'tier': tier['name'], 'model': model_names[attempt], 'hedged': attempt > 0}, result)
+        upgrade_on = tier.get('upgrade_on_confidence') or ()
+        if index + 1 < len(tiers) and isinstance(result, dict) and result.get('ai_confidence') in upgrade_on:
+            # Ответ сохранен как запасной, пробуем более сильную модель
+            logging.info(f"Уровень '{tier['name']}' ответил с уверенностью {result.get('ai_confidence')}, уточняем.")
+            continue
+        break
+
+    if served is None:
+        raise last_error
+    g.ai_served, ai_result_json = served
+    print(f"--- Ответ получен от уровня '{g.ai_served['tier']}' ({g.ai_served['model']}) ---")
+    if use_cache:
+        ai_cache.cache_response(cache_key, ai_result_json)
+    return ai_result_json
+
+
+def index_known_place(lat, lng, title, place_name, osm_place, wiki_url=None):
+    """Заносит место и найденные для него POI/статью в пространственный индекс."""
+    index_place('place_info', place_cache_key(lat, lng), title or place_name, lat, lng)
+    poi_lat, poi_lng = lat, lng
+    if osm_place:
+        poi_lat, poi_lng = osm_place['lat'], osm_place['lng']
+        index_place('geocoder', osm_place['osm_ref'], place_name, poi_lat, poi_lng)
+    if wiki_url:
+        wiki_title = urllib.parse.unquote(wiki_url.rsplit('/', 1)[-1]).replace('_', ' ')
+        index_place('wikipedia', wiki_url, wiki_title, poi_lat, poi_lng)
+    viewport.invalidate_tiles({(lat, lng), (poi_lat, poi_lng)})
+
+
+def build_recommendations_prompt(interests, visited_summary):
+    """Промпт рекомендаций по интересам и краткому списку недавних мест."""
+    return f"""
+    Основываясь на профиле пользователя, сгенерируй 3-5 рекомендаций для путешествий в виде JSON массива.
+
+    Профиль пользователя:
+    - Интересы: {', '.join(interests) if interests else 'Не указаны'}
+    - Недавно посещенные места (часть): {'; '.join(visited_summary) if visited_summary else 'Нет записей'}
+
+    Сгенерируй JSON массив объектов, соответствующий этой структуре:
+    {RECOMMENDATIONS_EXPECTED_JSON_FORMAT}
+
+    Требования:
+    - Рекомендуй места, которые пользователь недавно не посещал (если возможно).
+    - Рекомендации должны соответствовать интересам пользователя.
+    - Укажи краткую причину (`reason`), объясняющую релевантность.
+    - Включи географические координаты (`lat`, `lng`).
+    - Включи релевантные теги (`tags`) из списка интересов пользователя.
+    - Фокусируйся на разнообразных и интересных локациях.
+
+    Верни ТОЛЬКО валидный JSON массив, без вводного текста или markdown.
+    """
+
+
+def generate_recommendations(interests, visited_summary):
+    """Генерирует рекомендации через AI. Вызывает исключения при ошибках.
+
+    Кэш по промпту не используется: промпт зависит только от отпечатка профиля,
+    а срок жизни ответа задает таблица recommendations (RECOMMENDATIONS_MAX_AGE).
+    """
+    result = call_ai_model(
+        build_recommendations_prompt(interests, visited_summary), RECOMMENDATIONS_EXPECTED_JSON_FORMAT,
+        use_cache=False
+    )
+    if not isinstance(result, list):
+        logging.error(f"Результат рекомендаций AI не является списком: {type(result)}")
+        raise ValueError("Неожиданный тип результата рекомендаций от AI")
+    return result
+
+
 def login_required(view):
     """Декоратор для требования аутентификации."""
     @functools.wraps(view)
@@ -188,19 +391,6 @@ def login_required(view):
     return wrapped_view
 
 
-def sanitize_mermaid_text(text):
-    """Экранирует текст для Mermaid."""
-    if not isinstance(text, str):
-        text = str(text)
-    return (
-        text.replace(')', r'\)').replace('(', r'\(')
-        .replace('"', '&quot;').replace('#', '')
-        .replace('{', r'\{').replace('}', r'\}')
-        .replace('[', r'\[').replace(']', r'\]')
-        .strip()
-    )
-
-
 # --- Фабрика приложения Flask ---
 def create_app(test_config=None):
     """Создает и конфигурирует экземпляр приложения Flask."""
@@ -215,6 +405,92 @@ def create_app(test_config=None):
         WIKI_USER_AGENT='InteractiveMapApp/1.3 (MyMapApp; contact@example.com)',
         GEOPY_USER_AGENT='InteractiveMapApp/1.3 (MyMapApp; contact@example.com)',
         GEOPY_TIMEOUT=10,
+        # Дедлайны, уровни моделей и хеджирование внешних вызовов (см. hedging.py)
+        GOOGLE_GEMINI_MODEL_TIERS=None,  # Например: [{'model': 'gemini-1.5-flash-8b', 'deadline': 5}, {'model': 'gemini-1.5-flash', 'deadline': 20}]
+        AI_TIMEOUT=30,
+        AI_HEDGE_ENABLED=True,
+        AI_HEDGE_DEFAULT_DELAY=8.0,  # Пока не набралась статистика для p95
+        GEOPY_HEDGE_ENABLED=False,  # Публичный Nominatim просит не дублировать запросы
+        GEOPY_HEDGE_DOMAIN=None,
+        GEOPY_HEDGE_DEFAULT_DELAY=2.0,
+        HEDGE_MIN_DELAY=0.5,
+        HEDGE_POOL_SIZE=32,
+        # Кэш ответов Gemini (по промпту и по распознанному месту)
+        AI_CACHE_ENABLED=True,
+        AI_CACHE_TTL=3600 * 24 * 7,
+        # Хеширование паролей: параметры и пул процессов
+        PASSWORD_HASH_METHOD='scrypt:32768:8:1',
+        PASSWORD_HASH_SALT_LENGTH=16,
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_MAX_PENDING=32,
+        PASSWORD_HASH_TIMEOUT=10,
+        # Время жизни кэша пользователей в памяти процесса (секунды)
+        USER_CACHE_TTL=30,
+        # Кэши построителя Mermaid-схем (количество записей)
+        SCHEME_PLACE_STORE_SIZE=1024,
+        SCHEME_CACHE_SIZE=1024,
+        # HTTP-кэширование и сжатие ответов
+        PLACE_INFO_MAX_AGE=3600,
+        COMPRESS_ENABLED=True,
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_GZIP_LEVEL=6,
+        COMPRESS_BROTLI_QUALITY=5,
+        COMPRESS_MIMETYPES=('application/json', 'text/html', 'text/css', 'application/javascript'),
+        # Бэкенд кэша: 'sqlite' (таблица cache), 'mmap' (общий файл на хосте), 'redis'
+        CACHE_BACKEND=os.environ.get('CACHE_BACKEND', 'sqlite'),
+        CACHE_DEFAULT_TTL=3600 * 24 * 7,
+        CACHE_MMAP_PATH=None,  # По умолчанию instance/cache.mmap
+        CACHE_MMAP_SLOTS=4096,
+        CACHE_MMAP_SLOT_SIZE=16384,
+        CACHE_REDIS_URL=os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'),
+        CACHE_REDIS_PREFIX='aitravel:',
+        CACHE_REDIS_TIMEOUT=2,
+        # Запись трафика (JSONL с ротацией) и подмена внешних сервисов записанными ответами
+        TRAFFIC_CAPTURE_ENABLED=os.environ.get('TRAFFIC_CAPTURE', 'False').lower() in ['true', '1', 'yes'],
+        TRAFFIC_CAPTURE_DIR=None,  # По умолчанию instance/traffic
+        TRAFFIC_CAPTURE_SAMPLE_RATE=1.0,
+        TRAFFIC_CAPTURE_UPSTREAMS=False,
+        TRAFFIC_CAPTURE_MAX_BYTES=50 * 1024 * 1024,
+        TRAFFIC_CAPTURE_BACKUP_COUNT=5,
+        UPSTREAM_STUB_PATH=os.environ.get('UPSTREAM_STUB_PATH'),
+        UPSTREAM_STUB_STRICT=False,
+        UPSTREAM_STUB_FALLBACK=True,
+        # /places/in-viewport: тайлы, кластеризация и их кэш
+        VIEWPORT_MAX_ZOOM=19,
+        VIEWPORT_MAX_TILES=64,
+        VIEWPORT_CLUSTER_GRID=8,
+        VIEWPORT_CLUSTER_MAX_ZOOM=17,
+        VIEWPORT_TILE_MAX_PLACES=2000,
+        VIEWPORT_TILE_TTL=60,
+        VIEWPORT_TILE_CACHE_SIZE=4096,
+        VIEWPORT_PLACE_INFO_MAX_AGE=3600 * 6,  # Совпадает со сроком кэша мест
+        # Профилирование запросов и запись медленных запросов (см. profiling.py)
+        PROFILING_ENABLED=os.environ.get('PROFILING', 'False').lower() in ['true', '1', 'yes'],
+        PROFILING_SAMPLE_RATE=0.0,
+        PROFILING_SAMPLE_INTERVAL=0.005,
+        PROFILING_SLOW_THRESHOLD_MS=3000,
+        PROFILING_TRIGGER_TOKEN=os.environ.get('PROFILING_TRIGGER_TOKEN'),
+        PROFILING_DIR=None,  # По умолчанию instance/profiles
+        PROFILING_RING_SIZE=200,
+        # Контроль допуска для дорогих запросов (на воркер и на хост)
+        ADMISSION_ENABLED=True,
+        ADMISSION_WORKER_LIMITS={'cold_place_info': 4, 'recommendations': 2},
+        ADMISSION_GLOBAL_LIMITS={'cold_place_info': 16, 'recommendations': 8},
+        ADMISSION_MAX_QUEUE={'cold_place_info': 16, 'recommendations': 4},
+        ADMISSION_QUEUE_TIMEOUT=2.0,
+        ADMISSION_RETRY_AFTER=5,
+        ADMISSION_DEGRADED_PLACE_INFO=True,
+        ADMISSION_DIR=None,  # По умолчанию instance/admission
+        # Хранилище обогащающих данных (см. blob_store.py): срок артефактов и ссылок источников
+        BLOB_TTL=3600 * 24 * 30,  # Не меньше сроков кэша мест и AI_CACHE_TTL
+        BLOB_REF_TTLS={'wikipedia': 3600 * 24 * 7, 'web': 3600 * 24},
+        # Хранилище рекомендаций и `flask precompute-recommendations`
+        RECOMMENDATIONS_MAX_AGE=3600 * 24,
+        RECOMMENDATIONS_ACTIVE_DAYS=30,
+        RECOMMENDATIONS_BATCH_CONCURRENCY=4,
+        RECOMMENDATIONS_BATCH_RATE=30,  # Вызовов LLM в минуту
+        RECOMMENDATIONS_QUOTA_RETRIES=3,
+        RECOMMENDATIONS_QUOTA_BACKOFF=30,
     )
 
     # Загрузка из instance/config.py
@@ -243,6 +519,7 @@ def create_app(test_config=None):
     try:
         genai.configure(api_key=app.config['GOOGLE_API_KEY'])
         app.ai_model = genai.GenerativeModel(app.config['GOOGLE_GEMINI_MODEL'])
+        app.ai_models = {app.config['GOOGLE_GEMINI_MODEL']: app.ai_model}
         app.generation_config = genai.GenerationConfig(response_mime_type="application/json")
         logging.info(f"Клиент Google Gemini сконфигурирован для модели: {app.config['GOOGLE_GEMINI_MODEL']}")
     except Exception as e:
@@ -251,11 +528,22 @@ def create_app(test_config=None):
 
     # --- Инициализация базы данных ---
     init_app(app)
-
+    app.cache_backend = cache_backends.create_backend(app)
+    logging.info(f"Бэкенд кэша: {app.cache_backend.name}")
+    http_cache.init_app(app)
+    traffic.init_app(app)
+    cache_snapshot.init_app(app)
+    profiling.init_app(app)
+    admission.init_app(app)
+    recommendations.init_app(app, generate_recommendations)
+    scheme.configure(app.config['SCHEME_PLACE_STORE_SIZE'], app.config['SCHEME_CACHE_SIZE'])
+
+    # Изменения схемы для существующих баз применяются при первом соединении (get_db),
+    # поэтому `flask init-db` работает и на базе, которую нельзя обновить
     with app.app_context():
         db_path = current_app.config['DATABASE']
-        if not os.path.exists(db_path):
-            logging.info(f"Файл базы данных не найден в {db_path}. Инициализация схемы...")
+        if not os.path.exists(db_path) or not schema_exists(get_db(upgrade=False)):
+            logging.info(f"Схема базы данных не найдена в {db_path}. Инициализация схемы...")
             init_db()
 
     # --- Blueprint для аутентификации ---
@@ -269,10 +557,7 @@ def create_app(test_config=None):
             g.user = None
         else:
             try:
-                db = get_db()
-                g.user = db.execute(
-                    'SELECT id, username FROM users WHERE id = ?', (user_id,)
-                ).fetchone()
+                g.user = get_cached_user(user_id, current_app.config['USER_CACHE_TTL'])
                 if g.user is None:
                     session.clear()
                     logging.warning(f"ID пользователя {user_id} из сессии не найден в БД.")
@@ -305,7 +590,7 @@ def create_app(test_config=None):
                 try:
                     db.execute(
                         "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-                        (username, generate_password_hash(password)),
+                        (username, hash_password(password)),
                     )
                     db.commit()
                     logging.info(f"Пользователь '{username}' успешно зарегистрирован.")
@@ -314,6 +599,9 @@ def create_app(test_config=None):
                 except sqlite3.Error as e:
                     error = f"Ошибка базы данных при регистрации: {e}"
                     logging.error(error)
+                except PasswordHasherBusy as e:
+                    error = 'Сервер перегружен, попробуйте зарегистрироваться позже.'
+                    logging.warning(f"Регистрация '{username}' отклонена: {e}")
 
             if error:
                 flash(error, 'danger')
@@ -340,13 +628,26 @@ def create_app(test_config=None):
                     user = db.execute(
                         'SELECT * FROM users WHERE username = ?', (username,)
                     ).fetchone()
-                    if user is None or not check_password_hash(user['password_hash'], password):
+                    if user is None or not verify_password(user['password_hash'], password):
                         error = 'Неверное имя пользователя или пароль.'
+                    elif needs_rehash(user['password_hash']):
+                        # Параметры хеширования изменились — прозрачно перехешируем пароль.
+                        # Вход уже подтвержден: при неудаче перехешируем при следующем входе
+                        try:
+                            if update_user_password_hash(user['id'], hash_password(password)):
+                                logging.info(f"Хеш пароля пользователя ID {user['id']} обновлен.")
+                        except (PasswordHasherBusy, sqlite3.Error) as e:
+                            logging.warning(f"Не удалось перехешировать пароль пользователя ID {user['id']}: {e}")
                 except sqlite3.Error as e:
                     error = f"Ошибка базы данных при входе: {e}"
                     logging.error(error)
+                except PasswordHasherBusy as e:
+                    error = 'Сервер перегружен, попробуйте войти позже.'
+                    logging.warning(f"Вход '{username}' отклонен: {e}")
 
             if error is None and user:
+                invalidate_cached_user(user['id'])
+                record_login(user['id'])
                 session.clear()
                 session['user_id'] = user['id']
                 session['username'] = user['username']
@@ -363,6 +664,8 @@ def create_app(test_config=None):
     def logout_route():
         """Обрабатывает выход пользователя."""
         username = session.get('username', 'Пользователь')
+        if session.get('user_id') is not None:
+            invalidate_cached_user(session['user_id'])
         session.clear()
         g.user = None
         flash(f'{username}, вы успешно вышли.', 'info')
@@ -413,52 +716,139 @@ def create_app(test_config=None):
         """Рендерит главную страницу карты."""
         return render_template('index.html', user=g.user)
 
-    @app.route('/get-place-info', methods=['POST'])
+    @app.route('/get-place-info', methods=['GET', 'POST'])
     def get_place_info_route():
-        """Обрабатывает запрос информации о месте по координатам."""
-        if not request.json or 'lat' not in request.json or 'lng' not in request.json:
-            return jsonify({"error": "Отсутствуют координаты"}), 400
+        """Обрабатывает запрос информации о месте по координатам.
+
+        GET-вариант (?lat=&lng=) кэшируется браузером по ETag/Cache-Control.
+        Параметр view=slim убирает тяжелые поля (web_results, wikipedia_summary),
+        include=<поля> возвращает выбранные из них обратно.
+        """
+        if request.method == 'GET':
+            params = request.args
+            lat = request.args.get('lat', type=float)
+            lng = request.args.get('lng', type=float)
+            if lat is None or lng is None:
+                return jsonify({"error": "Отсутствуют координаты"}), 400
+        else:
+            if not request.json or 'lat' not in request.json or 'lng' not in request.json:
+                return jsonify({"error": "Отсутствуют координаты"}), 400
+            params = request.json
+            lat = request.json['lat']
+            lng = request.json['lng']
+
+        slim = str(params.get('view', '')).lower() == 'slim'
+        include = http_cache.parse_include(params.get('include'))
+
+        def place_info_response(data, cache_status):
+            g.cache_status = cache_status
+            with stage('response'):
+                if slim:
+                    data = http_cache.slim_payload(data, include)
+                response = http_cache.cacheable_json(
+                    data,
+                    max_age=current_app.config['PLACE_INFO_MAX_AGE'],
+                    private=g.user is not None
+                )
+            response.headers['X-Cache'] = cache_status
+            return response
 
-        lat = request.json['lat']
-        lng = request.json['lng']
         user_id = g.user['id'] if g.user else None
         interests = get_user_interests(user_id) if user_id else []
+        g.interests = interests
 
         logging.info(f"Запрос инфо: Lat={lat}, Lng={lng}, UserID={user_id}, Interests={interests}")
 
-        cached_data = get_cached_place_info(lat, lng)
+        with stage('cache_lookup'):
+            cached_data = blob_store.hydrate(get_cached_place_info(lat, lng))
         if cached_data:
             logging.info("Возврат из кэша.")
             cached_data['requested_lat'] = lat
             cached_data['requested_lng'] = lng
-            return jsonify(cached_data)
+            cached_data['place_key'] = scheme.remember_place(cached_data)
+            return place_info_response(cached_data, 'HIT')
 
         try:
-            logging.info("Получение деталей местоположения...")
-            place_name, address_info = get_location_details(lat, lng)
+            admission.admit(admission.COLD_PLACE_INFO)
+        except admission.AdmissionRejected as e:
+            if not current_app.config['ADMISSION_DEGRADED_PLACE_INFO']:
+                raise
+            # Деградированный ответ без AI-полей вместо ожидания в очереди
+            logging.warning(f"Холодный запрос инфо отклонен ({e.reason}), деградированный ответ.")
+            g.cache_status = 'DEGRADED'
+            response = jsonify({
+                "title": f"Location at {lat:.5f}, {lng:.5f}",
+                "requested_lat": lat,
+                "requested_lng": lng,
+                "degraded": True,
+                "retry_after": e.retry_after,
+            })
+            response.headers['Retry-After'] = str(e.retry_after)
+            response.headers['X-Cache'] = 'DEGRADED'
+            response.cache_control.no_store = True
+            return response
 
+        try:
+            logging.info("Получение деталей местоположения...")
+            with stage('geocode'):
+                place_name, address_info, osm_place = get_location_details(lat, lng)
+            osm_ref = osm_place['osm_ref'] if osm_place else None
+
+            # Клики рядом, попавшие в тот же POI, используют одну генерацию
+            shared_key = ai_cache.place_cache_key(
+                osm_ref or place_name, interests,
+                ai_model_chain(), current_app.generation_config
+            )
+            with stage('ai_cache_lookup'):
+                shared_result = blob_store.hydrate(ai_cache.get_cached_response(shared_key))
+            if isinstance(shared_result, dict):
+                logging.info(f"Возврат генерации, общей для места '{place_name}' ({osm_ref}).")
+                shared_result['requested_lat'] = lat
+                shared_result['requested_lng'] = lng
+                with stage('cache_write'):
+                    cache_place_info(lat, lng, blob_store.dehydrate(shared_result))
+                    index_known_place(lat, lng, shared_result.get('title'), place_name, osm_place)
+                shared_result['place_key'] = scheme.remember_place(shared_result)
+                return place_info_response(shared_result, 'SHARED')
+
+            # Сводка и результаты поиска для уже известного POI берутся из хранилища артефактов
             logging.info("Получение информации из Википедии...")
-            wiki_summary, wiki_url = get_wikipedia_info(place_name, lat, lng)
+            with stage('wikipedia'):
+                wiki = blob_store.lookup('wikipedia', osm_ref or place_name)
+                if wiki is not None:
+                    wiki_summary, wiki_url = wiki['value'], wiki.get('url')
+                else:
+                    wiki_summary, wiki_url = get_wikipedia_info(place_name, lat, lng)
+                    blob_store.remember('wikipedia', osm_ref or place_name, wiki_summary, url=wiki_url)
 
             logging.info("Поиск в интернете...")
-            web_results = search_web(place_name)
+            with stage('web_search'):
+                web = blob_store.lookup('web', place_name)
+                if web is not None:
+                    web_results = web['value']
+                else:
+                    web_results = search_web(place_name)
+                    if web_results:  # Пустой список - обычно ошибка поиска, не кэшируем
+                        blob_store.remember('web', place_name, web_results)
 
             logging.info("Подготовка промпта и вызов AI...")
-            prompt = f"""
-            Проанализируй местоположение: Lat={lat}, Lng={lng}.
-            Вероятное название/район: {place_name}
-            Детали адреса: {json.dumps(address_info) if address_info else 'Недоступно'}
-            Сводка из Википедии: {wiki_summary}
-            Результаты поиска в интернете: {json.dumps(web_results)}
-            Интересы пользователя: {', '.join(interests) if interests else 'Нет'}.
-
-            Задача: Сгенерируй краткое, увлекательное описание, фокусируясь на аспектах, релевантных интересам пользователя. Если точные координаты неинтересны, опиши ближайшую релевантную точку интереса или общий характер местности, упоминая интересы пользователя.
-
-            Вывод ДОЛЖЕН быть ЕДИНСТВЕННЫМ, валидным JSON объектом, соответствующим этому описанию структуры:
-            {PLACE_INFO_EXPECTED_JSON_FORMAT}
-            Адаптируй поля 'description' и 'details' под указанные Интересы пользователя. Включи '{wiki_url}' в 'sources', если он доступен и релевантен. Не добавляй никаких вводных фраз типа "Вот JSON:" или markdown разметку ```json ... ```.
-            """
-            ai_result = call_ai_model(prompt, PLACE_INFO_EXPECTED_JSON_FORMAT)
+            with stage('prompt_build'):
+                prompt = f"""
+                Проанализируй местоположение: Lat={lat}, Lng={lng}.
+                Вероятное название/район: {place_name}
+                Детали адреса: {json.dumps(address_info) if address_info else 'Недоступно'}
+                Сводка из Википедии: {wiki_summary}
+                Результаты поиска в интернете: {json.dumps(web_results)}
+                Интересы пользователя: {', '.join(interests) if interests else 'Нет'}.
+
+                Задача: Сгенерируй краткое, увлекательное описание, фокусируясь на аспектах, релевантных интересам пользователя. Если точные координаты неинтересны, опиши ближайшую релевантную точку интереса или общий характер местности, упоминая интересы пользователя.
+
+                Вывод ДОЛЖЕН быть ЕДИНСТВЕННЫМ, валидным JSON объектом, соответствующим этому описанию структуры:
+                {PLACE_INFO_EXPECTED_JSON_FORMAT}
+                Адаптируй поля 'description' и 'details' под указанные Интересы пользователя. Включи '{wiki_url}' в 'sources', если он доступен и релевантен. Не добавляй никаких вводных фраз типа "Вот JSON:" или markdown разметку ```json ... ```.
+                """
+            with stage('ai_call'):
+                ai_result = call_ai_model(prompt, PLACE_INFO_EXPECTED_JSON_FORMAT)
 
             if isinstance(ai_result, dict):
                 ai_result['requested_lat'] = lat
@@ -466,15 +856,26 @@ def create_app(test_config=None):
                 ai_result['identified_place_name'] = place_name
                 ai_result['wikipedia_summary'] = wiki_summary
                 ai_result['web_results'] = web_results
+                served = g.get('ai_served') or {}
+                ai_result['ai_model_tier'] = served.get('tier')
+                ai_result['ai_model'] = served.get('model')
                 if wiki_url and 'sources' in ai_result and isinstance(ai_result['sources'], list) and wiki_url not in ai_result['sources']:
                     ai_result['sources'].insert(0, wiki_url)
                 elif wiki_url and ('sources' not in ai_result or not isinstance(ai_result.get('sources'), list)):
                     ai_result['sources'] = [wiki_url]
 
                 logging.info("Кэширование успешного результата AI.")
-                cache_place_info(lat, lng, ai_result)
-
-                return jsonify(ai_result)
+                with stage('cache_write'):
+                    stored_result = blob_store.dehydrate(ai_result)
+                    cache_place_info(lat, lng, stored_result)
+                    index_known_place(lat, lng, ai_result.get('title'), place_name, osm_place, wiki_url)
+                    ai_cache.cache_response(shared_key, {
+                        key: value for key, value in stored_result.items()
+                        if key not in ('requested_lat', 'requested_lng')
+                    })
+
+                ai_result['place_key'] = scheme.remember_place(ai_result)
+                return place_info_response(ai_result, 'MISS')
             else:
                 logging.error("Результат AI не является словарем после успешного вызова.")
                 raise ValueError("Неожиданный тип результата от AI")
@@ -483,52 +884,58 @@ def create_app(test_config=None):
             logging.error(f"Ошибка при обработке /get-place-info: {type(e).__name__}: {e}", exc_info=True)
             return jsonify({"error": "Внутренняя ошибка сервера", "details": str(e)}), 500
 
+    @app.route('/places/in-viewport', methods=['GET'])
+    def places_in_viewport_route():
+        """Возвращает уже известные места (и их кластеры) в видимой области карты.
+
+        Параметры: bbox=south,west,north,east и zoom. LLM не вызывается.
+        """
+        try:
+            bbox = viewport.parse_bbox(request.args.get('bbox'))
+            zoom = request.args.get('zoom', type=int)
+            if zoom is None:
+                raise viewport.ViewportError("Отсутствует параметр zoom")
+        except viewport.ViewportError as e:
+            return jsonify({"error": str(e)}), 400
+
+        result = viewport.places_in_viewport(bbox, zoom)
+        return http_cache.cacheable_json(result, max_age=current_app.config['VIEWPORT_TILE_TTL'])
+
     @app.route('/get-recommendations', methods=['GET'])
     def get_recommendations_route():
-        """Генерирует рекомендации с помощью AI."""
+        """Возвращает предвычисленные рекомендации или генерирует их с помощью AI."""
         user_id = g.user['id'] if g.user else None
         if not user_id:
             return jsonify({"error": "Требуется вход для получения рекомендаций"}), 401
 
         try:
-            interests = get_user_interests(user_id)
-            visited = get_visited_places(user_id)
-
-            logging.info(f"Генерация рекомендаций для UserID={user_id}, Interests={interests}, VisitedCount={len(visited)}")
-
-            visited_summary = [
-                f"'{v.get('place_name', 'Unknown')}' ({v['lat']:.3f},{v['lng']:.3f})"
-                for v in visited[:10]
-            ]
-
-            rec_prompt = f"""
-            Основываясь на профиле пользователя, сгенерируй 3-5 рекомендаций для путешествий в виде JSON массива.
-
-            Профиль пользователя:
-            - Интересы: {', '.join(interests) if interests else 'Не указаны'}
-            - Недавно посещенные места (часть): {'; '.join(visited_summary) if visited_summary else 'Нет записей'}
-
-            Сгенерируй JSON массив объектов, соответствующий этой структуре:
-            {RECOMMENDATIONS_EXPECTED_JSON_FORMAT}
-
-            Требования:
-            - Рекомендуй места, которые пользователь недавно не посещал (если возможно).
-            - Рекомендации должны соответствовать интересам пользователя.
-            - Укажи краткую причину (`reason`), объясняющую релевантность.
-            - Включи географические координаты (`lat`, `lng`).
-            - Включи релевантные теги (`tags`) из списка интересов пользователя.
-            - Фокусируйся на разнообразных и интересных локациях.
-
-            Верни ТОЛЬКО валидный JSON массив, без вводного текста или markdown.
-            """
+            interests, visited_summary, fingerprint = recommendations.user_profile(user_id)
+            g.interests = interests
+            stored = get_stored_recommendations(fingerprint, current_app.config['RECOMMENDATIONS_MAX_AGE'])
+        except Exception as e:
+            logging.error(f"Ошибка при чтении профиля для рекомендаций: {type(e).__name__}: {e}", exc_info=True)
+            return jsonify({"error": "Не удалось сгенерировать рекомендации", "details": str(e)}), 500
+        if stored is not None:
+            g.request_class = admission.CACHE_HIT
+            g.cache_status = 'PRECOMPUTED'
+            response = jsonify(stored)
+            response.headers['X-Cache'] = 'PRECOMPUTED'
+            return response
 
-            recommendations_result = call_ai_model(rec_prompt, RECOMMENDATIONS_EXPECTED_JSON_FORMAT)
+        admission.admit(admission.RECOMMENDATIONS)
 
-            if isinstance(recommendations_result, list):
-                return jsonify(recommendations_result)
-            else:
-                logging.error(f"Результат рекомендаций AI не является списком: {type(recommendations_result)}")
-                raise ValueError("Неожиданный тип результата рекомендаций от AI")
+        try:
+            logging.info(f"Генерация рекомендаций для UserID={user_id}, Interests={interests}, VisitedCount={len(visited_summary)}")
+            recommendations_result = generate_recommendations(interests, visited_summary)
+            served = g.get('ai_served') or {}
+            store_recommendations(fingerprint, recommendations_result, served.get('model'))
+
+            g.cache_status = 'MISS'
+            response = jsonify(recommendations_result)
+            response.headers['X-Cache'] = 'MISS'
+            if served:
+                response.headers['X-AI-Tier'] = served['tier']
+            return response
 
         except Exception as e:
             logging.error(f"Ошибка при обработке /get-recommendations: {type(e).__name__}: {e}", exc_info=True)
@@ -536,79 +943,48 @@ def create_app(test_config=None):
 
     @app.route('/generate-scheme', methods=['POST'])
     def generate_scheme_route():
-        """Генерирует данные для Mermaid mind map."""
-        if not request.json or 'place_data' not in request.json:
+        """Генерирует данные для Mermaid mind map.
+
+        Принимает либо place_key (выдается /get-place-info), либо полный place_data.
+        """
+        payload = request.get_json(silent=True) or {}
+        place_key = payload.get('place_key')
+        place_data = payload.get('place_data')
+
+        if place_data is None and place_key:
+            place_data = scheme.get_remembered_place(place_key)
+            if place_data is None and 'lat' in payload and 'lng' in payload:
+                # Ключ вытеснен или выдан другим воркером — восстанавливаем из кэша мест
+                place_data = blob_store.hydrate(get_cached_place_info(payload['lat'], payload['lng']))
+                if place_data:
+                    place_key = scheme.remember_place(place_data)
+            if place_data is None:
+                return jsonify({
+                    "error": "Данные о месте не найдены по ключу, отправьте place_data",
+                    "place_key": place_key
+                }), 404
+        elif place_data is None:
             return jsonify({"error": "Отсутствуют данные о месте"}), 400
-
-        place_data = request.json['place_data']
+        else:
+            place_key = None
 
         if not isinstance(place_data, dict) or place_data.get("error"):
             return jsonify({"error": "Невозможно сгенерировать схему из неверных данных"}), 400
 
         user_id = g.user['id'] if g.user else None
         interests = get_user_interests(user_id) if user_id else []
+        g.interests = interests
 
-        title = place_data.get('title', 'Местоположение')
-        description = place_data.get('description', '')
-        details = place_data.get('details', [])
-        sources = place_data.get('sources', [])
-        confidence = place_data.get('ai_confidence', 'Неизвестно')
-        wiki_summary = place_data.get('wikipedia_summary', '')
-        web_results = place_data.get('web_results', [])
-
-        logging.info(f"Генерация схемы для: '{title}', Уверенность: {confidence}")
-
-        mermaid_string = f"""mindmap
-  root(({sanitize_mermaid_text(title)}))
-    (AI Confidence: {sanitize_mermaid_text(confidence)})
-"""
-        if description:
-            mermaid_string += f"    (Desc: {sanitize_mermaid_text(description[:80])}...)\n"
-
-        if details:
-            mermaid_string += f"    ::icon(fa fa-list-ul) Key Details\n"
-            for detail in details:
-                if isinstance(detail, str) and detail.strip():
-                    mermaid_string += f"      - {sanitize_mermaid_text(detail[:100])}\n"
-
-        if wiki_summary and wiki_summary != "Соответствующая статья в Википедии не найдена.":
-            mermaid_string += f"    ::icon(fa fa-wikipedia-w) Wikipedia Summary\n"
-            mermaid_string += f"      ... {sanitize_mermaid_text(wiki_summary[:150])} ...\n"
-
-        if web_results:
-            mermaid_string += f"    ::icon(fa fa-globe) Web Results\n"
-            for result in web_results[:3]:
-                mermaid_string += f"      > {sanitize_mermaid_text(result.get('title', 'No title')[:60])}...\n"
-
-        related_interests = []
-        combined_text_lower = (description + " " + " ".join(map(str, details)) + " " + wiki_summary).lower()
-        for interest in interests:
-            if interest.lower() in combined_text_lower:
-                related_interests.append(interest)
-
-        if related_interests:
-            mermaid_string += f"    ::icon(fa fa-star) Related User Interests\n"
-            for interest in related_interests:
-                mermaid_string += f"      * {sanitize_mermaid_text(interest.capitalize())}\n"
-
-        valid_sources = [s for s in sources if isinstance(s, str) and s.strip() and s != 'N/A']
-        if valid_sources:
-            mermaid_string += f"    ::icon(fa fa-link) Sources\n"
-            for source in valid_sources:
-                if source.startswith(('http://', 'https://')):
-                    try:
-                        domain_parts = source.split('/')
-                        domain = domain_parts[2] if len(domain_parts) > 2 else source
-                        safe_source_url = source.replace('"', '&quot;')
-                        mermaid_string += f'      > <a href="{safe_source_url}" target="_blank">{sanitize_mermaid_text(domain)}</a>\n'
-                    except IndexError:
-                        mermaid_string += f"      > {sanitize_mermaid_text(source[:60])}...\n"
-                else:
-                    mermaid_string += f"      > {sanitize_mermaid_text(source[:60])}...\n"
+        logging.info(
+            f"Генерация схемы для: '{place_data.get('title', 'Местоположение')}', "
+            f"Уверенность: {place_data.get('ai_confidence', 'Неизвестно')}"
+        )
 
+        with stage('scheme_build'):
+            mermaid_string = scheme.build_mindmap(place_data, interests, place_key=place_key)
         scheme_data = {
             "type": "mermaid_mindmap",
-            "data": mermaid_string.strip()
+            "data": mermaid_string
         }
         return jsonify(scheme_data)
 
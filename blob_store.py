@@ -0,0 +1,131 @@
+# blob_store.py
+
+import hashlib
+import json
+import re
+from flask import current_app
+from database import cache_json, get_cached_json
+
+# Хранилище обогащающих данных с адресацией по содержимому поверх бэкенда кэша.
+#   blob:<sha256>          - сам артефакт (JSON), хранится один раз на содержимое;
+#   ref:<kind>:<sha256>    - ссылка "источник -> blob" со своим сроком жизни:
+#       wikipedia - сводка статьи (URL - атрибут ссылки) для распознанного места
+#                   (OSM id или имя): URL статьи до запроса к Википедии неизвестен;
+#       web       - результаты поиска по нормализованному запросу.
+# Записи кэша мест хранят вместо тяжелых полей ссылки "_blobs" и собираются
+# обратно при чтении; ссылки ref:* работают как кэши отдельных источников.
+# Сроки BLOB_TTL и BLOB_REF_TTLS передаются бэкенду как срок хранения (redis).
+
+BLOB_PREFIX = 'blob:'
+BLOB_FIELDS = ('wikipedia_summary', 'web_results')
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def normalize_ref(ref):
+    """Нормализует ссылку на источник (регистр и пробелы не важны)."""
+    return _WHITESPACE_RE.sub(' ', str(ref)).strip().lower()
+
+
+def blob_hash(value):
+    """Хеш содержимого по каноническому JSON."""
+    return _sha256(json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(',', ':')))
+
+
+def put_blob(value):
+    """Сохраняет артефакт и возвращает его хеш (повторная запись продлевает срок жизни)."""
+    digest = blob_hash(value)
+    cache_json(BLOB_PREFIX + digest, value, current_app.config['BLOB_TTL'])
+    return digest
+
+
+def get_blob(digest):
+    """Возвращает артефакт по хешу или None."""
+    return get_cached_json(BLOB_PREFIX + digest, current_app.config['BLOB_TTL'])
+
+
+def lookup(kind, ref):
+    """Кэш источника по ссылке kind/ref.
+
+    Возвращает словарь ссылки (с атрибутами, переданными в remember) и ключом
+    'value' с самим артефактом или None, если ссылка устарела или артефакт удален.
+    """
+    if ref is None:
+        return None
+    entry = get_cached_json(f"ref:{kind}:{_sha256(normalize_ref(ref))}", current_app.config['BLOB_REF_TTLS'][kind])
+    if not isinstance(entry, dict) or 'blob' not in entry:
+        return None
+    value = get_blob(entry['blob'])
+    if value is None:
+        return None
+    entry['value'] = value
+    return entry
+
+
+def remember(kind, ref, value, **attrs):
+    """Сохраняет артефакт и ссылку на него от источника kind/ref; возвращает хеш.
+
+    attrs - небольшие атрибуты, которые хранятся в самой ссылке (например, URL статьи).
+    """
+    digest = put_blob(value)
+    if ref is not None:
+        cache_json(
+            f"ref:{kind}:{_sha256(normalize_ref(ref))}", dict(attrs, blob=digest, ref=str(ref)),
+            current_app.config['BLOB_REF_TTLS'][kind]
+        )
+    return digest
+
+
+def ttl_for_key(key):
+    """Срок хранения для ключа хранилища артефактов (None для прочих ключей)."""
+    if key.startswith(BLOB_PREFIX):
+        return current_app.config['BLOB_TTL']
+    if key.startswith('ref:'):
+        return current_app.config['BLOB_REF_TTLS'].get(key.split(':', 2)[1])
+    return None
+
+
+def dehydrate(place_data):
+    """Копия записи о месте, где тяжелые поля заменены ссылками в "_blobs"."""
+    entry = dict(place_data)
+    blobs = {}
+    for field in BLOB_FIELDS:
+        if field in entry:
+            blobs[field] = put_blob(entry.pop(field))
+    if blobs:
+        entry['_blobs'] = blobs
+    return entry
+
+
+def hydrate(entry):
+    """Собирает запись о месте из ссылок; None, если какой-то артефакт уже удален."""
+    if not isinstance(entry, dict) or '_blobs' not in entry:
+        return entry
+    place_data = dict(entry)
+    for field, digest in place_data.pop('_blobs').items():
+        value = get_blob(digest)
+        if value is None:
+            return None
+        place_data[field] = value
+    return place_data
+
+
+def referenced_blobs(value):
+    """Хеши артефактов, на которые ссылается сериализованная запись кэша
+    (поле "_blobs" записи о месте или поле "blob" ссылки ref:*)."""
+    if '"_blobs"' not in value and '"blob"' not in value:
+        return []
+    try:
+        entry = json.loads(value)
+    except ValueError:
+        return []
+    if not isinstance(entry, dict):
+        return []
+    digests = list(entry.get('_blobs', {}).values())
+    if isinstance(entry.get('blob'), str):
+        digests.append(entry['blob'])
+    return digests
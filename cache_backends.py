@@ -0,0 +1,419 @@
+# cache_backends.py
+
+import datetime
+import fcntl
+import hashlib
+import mmap
+import os
+import socket
+import struct
+import threading
+import zlib
+from urllib.parse import unquote, urlparse
+from database import get_db
+
+# Бэкенды хранилища кэша. Все они хранят пары ключ -> (JSON-строка, ISO-время записи);
+# проверка свежести выполняется уровнем выше (database.get_cached_json).
+#   sqlite - таблица cache в основной БД (по умолчанию);
+#   mmap   - общий для всех воркеров на одном хосте файл, отображенный в память;
+#   redis  - любой сервер с протоколом Redis (RESP), общий для нескольких узлов.
+
+
+class CacheBackendError(RuntimeError):
+    """Ошибка хранилища кэша."""
+
+
+class CacheBackend:
+    """Базовый интерфейс бэкенда кэша."""
+
+    name = None
+
+    def get(self, key):
+        """Возвращает (value, timestamp_iso) или None."""
+        raise NotImplementedError
+
+    def set(self, key, value, timestamp, ttl=None):
+        """Сохраняет значение (строку) с временем записи в ISO-формате.
+
+        ttl - срок хранения в секундах для бэкендов, которые удаляют записи сами
+        (redis); остальные проверяют свежесть при чтении и его игнорируют.
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def items(self):
+        """Итерирует по всем записям: (key, value, timestamp_iso)."""
+        raise NotImplementedError
+
+    def merge(self, records, ttl_for=None):
+        """Записывает (key, value, timestamp_iso), только если запись новее имеющейся.
+
+        ttl_for(key) возвращает срок хранения записи (см. set) или None.
+        Возвращает список фактически записанных записей.
+        """
+        written = []
+        for key, value, timestamp in records:
+            existing = self.get(key)
+            if existing and datetime.datetime.fromisoformat(existing[1]) >= datetime.datetime.fromisoformat(timestamp):
+                continue
+            self.set(key, value, timestamp, ttl_for(key) if ttl_for else None)
+            written.append((key, value, timestamp))
+        return written
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Кэш в таблице cache основной SQLite-базы (соединение текущего запроса)."""
+
+    name = 'sqlite'
+
+    def get(self, key):
+        row = get_db().execute(
+            'SELECT json_result, timestamp FROM cache WHERE cache_key = ?', (key,)
+        ).fetchone()
+        return (row['json_result'], row['timestamp']) if row else None
+
+    def set(self, key, value, timestamp, ttl=None):
+        db = get_db()
+        # INSERT OR REPLACE атомарно заменит запись, если ключ уже существует
+        db.execute(
+            'INSERT OR REPLACE INTO cache (cache_key, json_result, timestamp) VALUES (?, ?, ?)',
+            (key, value, timestamp)
+        )
+        db.commit()
+
+    def delete(self, key):
+        db = get_db()
+        db.execute('DELETE FROM cache WHERE cache_key = ?', (key,))
+        db.commit()
+
+    def items(self):
+        cursor = get_db().execute('SELECT cache_key, json_result, timestamp FROM cache')
+        for row in cursor:
+            yield row['cache_key'], row['json_result'], row['timestamp']
+
+    def merge(self, records, ttl_for=None):
+        db = get_db()
+        written = []
+        # Одна транзакция на пачку записей; более старые записи не перезаписываются
+        with db:
+            for key, value, timestamp in records:
+                cursor = db.execute(
+                    """
+                    INSERT INTO cache (cache_key, json_result, timestamp) VALUES (?, ?, ?)
+                    ON CONFLICT (cache_key) DO UPDATE SET
+                        json_result = excluded.json_result, timestamp = excluded.timestamp
+                    WHERE excluded.timestamp > cache.timestamp
+                    """,
+                    (key, value, timestamp)
+                )
+                if cursor.rowcount:
+                    written.append((key, value, timestamp))
+        return written
+
+
+class MmapCacheBackend(CacheBackend):
+    """Кэш в общем файле, отображенном в память, для воркеров одного хоста.
+
+    Файл разбит на слоты фиксированного размера; ключ хешируется в слот с
+    небольшим линейным пробированием, при нехватке места вытесняется самая
+    старая запись из группы. Значения сжимаются zlib; записи, не влезающие в
+    слот, не кэшируются. Межпроцессная синхронизация - через fcntl.flock.
+    """
+
+    name = 'mmap'
+
+    _MAGIC = b'AITCACHE'
+    _HEADER = struct.Struct('<8sII')
+    _HEADER_SIZE = 64
+    # key_hash, stored_at (epoch), key_len, value_len
+    _SLOT_HEADER = struct.Struct('<QdII')
+    _PROBES = 4
+
+    def __init__(self, path, slot_count, slot_size):
+        self.path = path
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._map = None
+
+    def _ensure_open(self):
+        # После fork отображение наследуется, но flock нужен на своем дескрипторе
+        if self._map is not None and self._pid == os.getpid():
+            return
+        size = self._HEADER_SIZE + self.slot_count * self.slot_size
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        file = os.fdopen(fd, 'r+b')
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < size:
+                file.truncate(size)
+            cache_map = mmap.mmap(fd, size, mmap.MAP_SHARED)
+            magic, slot_count, slot_size = self._HEADER.unpack_from(cache_map, 0)
+            if magic != self._MAGIC:
+                self._HEADER.pack_into(cache_map, 0, self._MAGIC, self.slot_count, self.slot_size)
+            elif (slot_count, slot_size) != (self.slot_count, self.slot_size):
+                raise CacheBackendError(
+                    f"Файл кэша {self.path} создан с другой геометрией "
+                    f"({slot_count}x{slot_size}), удалите его или исправьте настройки."
+                )
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+        self._file, self._map, self._pid = file, cache_map, os.getpid()
+
+    @staticmethod
+    def _hash_key(key):
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+    def _slot_offset(self, index):
+        return self._HEADER_SIZE + index * self.slot_size
+
+    def _probe(self, key_hash):
+        start = key_hash % self.slot_count
+        for i in range(self._PROBES):
+            yield (start + i) % self.slot_count
+
+    def _read_slot(self, index):
+        offset = self._slot_offset(index)
+        key_hash, stored_at, key_len, value_len = self._SLOT_HEADER.unpack_from(self._map, offset)
+        return offset, key_hash, stored_at, key_len, value_len
+
+    def _decode(self, offset, key_len, value_len):
+        start = offset + self._SLOT_HEADER.size + key_len
+        return zlib.decompress(self._map[start:start + value_len]).decode('utf-8')
+
+    @staticmethod
+    def _to_iso(stored_at):
+        return datetime.datetime.fromtimestamp(stored_at, datetime.timezone.utc).isoformat()
+
+    def _find(self, key_bytes, key_hash):
+        for index in self._probe(key_hash):
+            offset, slot_hash, stored_at, key_len, value_len = self._read_slot(index)
+            if slot_hash != key_hash or key_len != len(key_bytes):
+                continue
+            key_start = offset + self._SLOT_HEADER.size
+            if self._map[key_start:key_start + key_len] == key_bytes:
+                return index
+        return None
+
+    def get(self, key):
+        key_bytes = key.encode('utf-8')
+        key_hash = self._hash_key(key)
+        with self._lock:
+            self._ensure_open()
+            fcntl.flock(self._file, fcntl.LOCK_SH)
+            try:
+                index = self._find(key_bytes, key_hash)
+                if index is None:
+                    return None
+                offset, _, stored_at, key_len, value_len = self._read_slot(index)
+                return self._decode(offset, key_len, value_len), self._to_iso(stored_at)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def set(self, key, value, timestamp, ttl=None):
+        key_bytes = key.encode('utf-8')
+        key_hash = self._hash_key(key)
+        payload = zlib.compress(value.encode('utf-8'))
+        if self._SLOT_HEADER.size + len(key_bytes) + len(payload) > self.slot_size:
+            print(f"Запись кэша {key} ({len(payload)} байт) не помещается в слот, пропуск.")
+            return
+        stored_at = datetime.datetime.fromisoformat(timestamp).timestamp()
+
+        with self._lock:
+            self._ensure_open()
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                index = self._find(key_bytes, key_hash)
+                if index is None:
+                    # Пустой слот или самая старая запись в группе пробирования
+                    index = min(self._probe(key_hash), key=lambda i: self._read_slot(i)[2])
+                offset = self._slot_offset(index)
+                # Сначала обнуляем хеш, чтобы читатель не увидел полузаписанный слот
+                self._SLOT_HEADER.pack_into(self._map, offset, 0, 0.0, 0, 0)
+                data_start = offset + self._SLOT_HEADER.size
+                self._map[data_start:data_start + len(key_bytes)] = key_bytes
+                value_start = data_start + len(key_bytes)
+                self._map[value_start:value_start + len(payload)] = payload
+                self._SLOT_HEADER.pack_into(
+                    self._map, offset, key_hash, stored_at, len(key_bytes), len(payload)
+                )
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def delete(self, key):
+        key_hash = self._hash_key(key)
+        with self._lock:
+            self._ensure_open()
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                index = self._find(key.encode('utf-8'), key_hash)
+                if index is not None:
+                    self._SLOT_HEADER.pack_into(self._map, self._slot_offset(index), 0, 0.0, 0, 0)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def items(self):
+        for index in range(self.slot_count):
+            with self._lock:
+                self._ensure_open()
+                fcntl.flock(self._file, fcntl.LOCK_SH)
+                try:
+                    offset, key_hash, stored_at, key_len, value_len = self._read_slot(index)
+                    if not key_hash:
+                        continue
+                    key_start = offset + self._SLOT_HEADER.size
+                    key = self._map[key_start:key_start + key_len].decode('utf-8')
+                    item = (key, self._decode(offset, key_len, value_len), self._to_iso(stored_at))
+                finally:
+                    fcntl.flock(self._file, fcntl.LOCK_UN)
+            yield item
+
+
+class _RespConnection:
+    """Минимальный клиент протокола Redis (RESP2) поверх сокета."""
+
+    def __init__(self, host, port, timeout):
+        self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._reader = self._sock.makefile('rb')
+
+    def close(self):
+        try:
+            self._reader.close()
+            self._sock.close()
+        except OSError:
+            pass
+
+    def command(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(f"${len(arg)}\r\n".encode() + arg + b"\r\n")
+        self._sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise CacheBackendError("Соединение с Redis закрыто.")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b'+':
+            return body.decode('utf-8')
+        if prefix == b'-':
+            raise CacheBackendError(f"Ошибка Redis: {body.decode('utf-8', 'replace')}")
+        if prefix == b':':
+            return int(body)
+        if prefix == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if prefix == b'*':
+            count = int(body)
+            if count < 0:
+                return None
+            return [self._read_reply() for _ in range(count)]
+        raise CacheBackendError(f"Неизвестный ответ Redis: {line!r}")
+
+
+class RedisCacheBackend(CacheBackend):
+    """Кэш на сервере с протоколом Redis; общий для всех воркеров и узлов.
+
+    Значение хранится как "<timestamp_iso>\\n<json>", срок жизни задается EX.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url, prefix, default_ttl, timeout):
+        parsed = urlparse(url)
+        if parsed.scheme != 'redis':
+            raise CacheBackendError(f"Неподдерживаемый адрес Redis: {url}")
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = _RespConnection(self.host, self.port, self.timeout)
+            if self.password:
+                conn.command('AUTH', self.password)
+            if self.db:
+                conn.command('SELECT', self.db)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _command(self, *args):
+        try:
+            return self._connection().command(*args)
+        except (OSError, CacheBackendError):
+            # Сбрасываем соединение, следующий вызов переподключится
+            conn = getattr(self._local, 'conn', None)
+            if conn is not None:
+                conn.close()
+            self._local.conn = None
+            raise
+
+    def get(self, key):
+        raw = self._command('GET', self.prefix + key)
+        if raw is None:
+            return None
+        timestamp, _, value = raw.decode('utf-8').partition('\n')
+        return value, timestamp
+
+    def set(self, key, value, timestamp, ttl=None):
+        args = ['SET', self.prefix + key, f"{timestamp}\n{value}"]
+        ttl = ttl or self.default_ttl
+        if ttl:
+            args += ['EX', int(ttl)]
+        self._command(*args)
+
+    def delete(self, key):
+        self._command('DEL', self.prefix + key)
+
+    def items(self):
+        cursor = '0'
+        while True:
+            cursor, keys = self._command('SCAN', cursor, 'MATCH', self.prefix + '*', 'COUNT', 500)
+            cursor = cursor.decode('utf-8')
+            if keys:
+                for full_key, raw in zip(keys, self._command('MGET', *keys)):
+                    if raw is None:
+                        continue
+                    timestamp, _, value = raw.decode('utf-8').partition('\n')
+                    yield full_key.decode('utf-8')[len(self.prefix):], value, timestamp
+            if cursor == '0':
+                break
+
+
+def create_backend(app):
+    """Создает бэкенд кэша по app.config['CACHE_BACKEND']."""
+    config = app.config
+    backend_name = config['CACHE_BACKEND']
+    if backend_name == 'sqlite':
+        return SQLiteCacheBackend()
+    if backend_name == 'mmap':
+        return MmapCacheBackend(
+            config.get('CACHE_MMAP_PATH') or os.path.join(app.instance_path, 'cache.mmap'),
+            config['CACHE_MMAP_SLOTS'],
+            config['CACHE_MMAP_SLOT_SIZE'],
+        )
+    if backend_name == 'redis':
+        return RedisCacheBackend(
+            config['CACHE_REDIS_URL'],
+            config['CACHE_REDIS_PREFIX'],
+            config['CACHE_DEFAULT_TTL'],
+            config['CACHE_REDIS_TIMEOUT'],
+        )
+    raise ValueError(f"Неизвестный бэкенд кэша: {backend_name}")
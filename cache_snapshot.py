@@ -0,0 +1,282 @@
+# cache_snapshot.py
+
+import contextlib
+import datetime
+import json
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+import zlib
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+import blob_store
+from database import index_place
+from viewport import ViewportError, parse_bbox
+
+# Снимки кэша для "прогрева" новых узлов: `flask cache-export` и `flask cache-import`.
+#
+# Формат файла: сигнатура SNAPSHOT_MAGIC, затем блоки "длина (uint32 LE) +
+# zlib-сжатые JSON-строки [key, value, timestamp]", в конце блок нулевой длины.
+# Блоки пишутся и читаются потоково, весь кэш в память не загружается.
+# Экспорт из SQLite идет через онлайн-бэкап (sqlite3.Connection.backup) во
+# временный файл порциями страниц, поэтому живые запросы не блокируются.
+# Импорт сливает записи пачками (одна транзакция на блок), побеждает более новая
+# запись. Артефакты blob:*, на которые ссылаются отобранные записи, экспортируются
+# и импортируются независимо от фильтров: импорт с фильтром читает снимок дважды
+# (первый проход собирает только хеши нужных артефактов), снимок из stdin для
+# этого копируется во временный файл. Перед `flask init-db` (он пересоздает
+# таблицу cache) стоит сделать экспорт.
+
+SNAPSHOT_MAGIC = b'AITSNAP1'
+_CHUNK_HEADER = struct.Struct('<I')
+_COORD_KEY = re.compile(r'^(-?\d+\.\d+)_(-?\d+\.\d+)$')
+
+
+def coordinate_key(key):
+    """Координаты из ключа кэша места ('lat_lng') или None для прочих ключей."""
+    match = _COORD_KEY.match(key)
+    if not match:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+
+def record_filter(bbox=None, since=None):
+    """Фильтр записей по области и времени записи.
+
+    При заданной области проходят только ключи с координатами внутри нее;
+    остальные ключи (ответы LLM и т.п.) экспортируются только без bbox.
+    """
+    def accept(key, timestamp):
+        if since is not None and datetime.datetime.fromisoformat(timestamp) < since:
+            return False
+        if bbox is None:
+            return True
+        coords = coordinate_key(key)
+        if coords is None:
+            return False
+        south, west, north, east = bbox
+        lat, lng = coords
+        in_lng = west <= lng <= east if west <= east else (lng >= west or lng <= east)
+        return south <= lat <= north and in_lng
+    return accept
+
+
+def with_referenced_blobs(records, fetch):
+    """Дополняет поток записей артефактами, на которые они ссылаются.
+
+    fetch(key) возвращает (value, timestamp) или None.
+    """
+    exported = set()
+    referenced = set()
+    for key, value, timestamp in records:
+        if key.startswith(blob_store.BLOB_PREFIX):
+            exported.add(key)
+        else:
+            referenced.update(blob_store.BLOB_PREFIX + digest for digest in blob_store.referenced_blobs(value))
+        yield key, value, timestamp
+    for key in sorted(referenced - exported):
+        entry = fetch(key)
+        if entry is not None:
+            yield key, entry[0], entry[1]
+
+
+def write_snapshot(output, records, chunk_size):
+    """Пишет записи блоками; возвращает количество записей."""
+    output.write(SNAPSHOT_MAGIC)
+    count = 0
+    chunk = []
+
+    def flush():
+        payload = zlib.compress(''.join(chunk).encode('utf-8'), 6)
+        output.write(_CHUNK_HEADER.pack(len(payload)))
+        output.write(payload)
+        chunk.clear()
+
+    for record in records:
+        chunk.append(json.dumps(record, ensure_ascii=False) + '\n')
+        count += 1
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    output.write(_CHUNK_HEADER.pack(0))
+    return count
+
+
+def read_snapshot(stream):
+    """Итерирует по блокам снимка: списки записей (key, value, timestamp)."""
+    if stream.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        raise click.ClickException("Файл не является снимком кэша.")
+    while True:
+        header = stream.read(_CHUNK_HEADER.size)
+        if len(header) < _CHUNK_HEADER.size:
+            raise click.ClickException("Снимок кэша обрезан (нет завершающего блока).")
+        (length,) = _CHUNK_HEADER.unpack(header)
+        if length == 0:
+            return
+        payload = stream.read(length)
+        if len(payload) < length:
+            raise click.ClickException("Снимок кэша обрезан.")
+        lines = zlib.decompress(payload).decode('utf-8').splitlines()
+        yield [tuple(json.loads(line)) for line in lines if line]
+
+
+@contextlib.contextmanager
+def sqlite_snapshot(database, pages_per_step=256, pause=0.005):
+    """Копия базы через онлайн-бэкап; источник блокируется только на время шага."""
+    handle, path = tempfile.mkstemp(
+        prefix='cache-snapshot-', suffix='.db', dir=os.path.dirname(os.path.abspath(database))
+    )
+    os.close(handle)
+    source = sqlite3.connect(database)
+    target = sqlite3.connect(path)
+    try:
+        source.backup(target, pages=pages_per_step, sleep=pause)
+        target.row_factory = sqlite3.Row
+        yield target
+    finally:
+        source.close()
+        target.close()
+        os.remove(path)
+
+
+def _parse_filters(bbox, max_age, since):
+    try:
+        bbox = parse_bbox(bbox) if bbox else None
+    except ViewportError as e:
+        raise click.BadParameter(str(e), param_hint='--bbox')
+    threshold = None
+    if since:
+        try:
+            threshold = datetime.datetime.fromisoformat(since)
+        except ValueError:
+            raise click.BadParameter(f"ожидается дата в формате ISO 8601: {since}", param_hint='--since')
+        if threshold.tzinfo is None:
+            threshold = threshold.replace(tzinfo=datetime.timezone.utc)
+    if max_age is not None:
+        age_threshold = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=max_age)
+        threshold = max(threshold, age_threshold) if threshold else age_threshold
+    return record_filter(bbox, threshold)
+
+
+def _needed_blobs(snapshot, accept):
+    """Первый проход импорта: ключи артефактов, на которые ссылаются принятые записи."""
+    needed = set()
+    for chunk in read_snapshot(snapshot):
+        for key, value, timestamp in chunk:
+            if not key.startswith(blob_store.BLOB_PREFIX) and accept(key, timestamp):
+                needed.update(blob_store.BLOB_PREFIX + digest for digest in blob_store.referenced_blobs(value))
+    return needed
+
+
+def _filter_options(command):
+    command = click.option('--since', help='Только записи не старше момента (ISO 8601, по умолчанию UTC).')(command)
+    command = click.option('--max-age', type=int, help='Только записи не старше N секунд.')(command)
+    command = click.option('--bbox', help='Только места в области south,west,north,east.')(command)
+    return command
+
+
+@click.command('cache-export')
+@with_appcontext
+@click.argument('output', type=click.File('wb'), default='-')
+@_filter_options
+@click.option('--chunk-size', default=500, show_default=True, help='Записей в одном сжатом блоке.')
+def cache_export_command(output, bbox, max_age, since, chunk_size):
+    """Экспортирует кэш в сжатый снимок (по умолчанию в stdout)."""
+    accept = _parse_filters(bbox, max_age, since)
+    backend = current_app.cache_backend
+    started = time.monotonic()
+
+    if backend.name == 'sqlite':
+        with sqlite_snapshot(current_app.config['DATABASE']) as snapshot:
+            rows = snapshot.execute('SELECT cache_key, json_result, timestamp FROM cache')
+            records = (
+                (row['cache_key'], row['json_result'], row['timestamp'])
+                for row in rows if accept(row['cache_key'], row['timestamp'])
+            )
+
+            def fetch(key):
+                return snapshot.execute(
+                    'SELECT json_result, timestamp FROM cache WHERE cache_key = ?', (key,)
+                ).fetchone()
+
+            count = write_snapshot(output, with_referenced_blobs(records, fetch), chunk_size)
+    else:
+        records = (record for record in backend.items() if accept(record[0], record[2]))
+        count = write_snapshot(output, with_referenced_blobs(records, backend.get), chunk_size)
+
+    click.echo(f"Экспортировано записей: {count} ({backend.name}, {time.monotonic() - started:.1f} с).", err=True)
+
+
+@click.command('cache-import')
+@with_appcontext
+@click.argument('snapshot', type=click.File('rb'), default='-')
+@_filter_options
+@click.option('--no-index', is_flag=True, help='Не добавлять импортированные места в индекс /places/in-viewport.')
+def cache_import_command(snapshot, bbox, max_age, since, no_index):
+    """Сливает снимок кэша с текущим кэшем (остаются более новые записи).
+
+    Фильтры применяются к записям, но не к артефактам blob:*: артефакт
+    импортируется, если на него ссылается хотя бы одна принятая запись.
+    """
+    accept = _parse_filters(bbox, max_age, since)
+    filtered = bool(bbox or max_age is not None or since)
+    backend = current_app.cache_backend
+    started = time.monotonic()
+    total = written_total = 0
+    available = set()       # Артефакты, переданные в merge (записаны или уже есть новее)
+    to_index = []
+
+    with contextlib.ExitStack() as stack:
+        needed = None
+        if filtered:
+            if not snapshot.seekable():
+                spool = stack.enter_context(tempfile.TemporaryFile())
+                shutil.copyfileobj(snapshot, spool)
+                snapshot = spool
+            snapshot.seek(0)
+            needed = _needed_blobs(snapshot, accept)
+            snapshot.seek(0)
+
+        def wanted(key, timestamp):
+            if needed is not None and key.startswith(blob_store.BLOB_PREFIX):
+                return key in needed
+            return accept(key, timestamp)
+
+        for chunk in read_snapshot(snapshot):
+            records = [(key, value, timestamp) for key, value, timestamp in chunk if wanted(key, timestamp)]
+            total += len(records)
+            available.update(record[0] for record in records if record[0].startswith(blob_store.BLOB_PREFIX))
+            written = backend.merge(records, ttl_for=blob_store.ttl_for_key)
+            written_total += len(written)
+            if not no_index:
+                to_index.extend(record for record in written if coordinate_key(record[0]) is not None)
+
+    # Места индексируются, только если их артефакты действительно есть в кэше
+    for key, value, timestamp in to_index:
+        refs = [blob_store.BLOB_PREFIX + digest for digest in blob_store.referenced_blobs(value)]
+        if any(ref not in available and backend.get(ref) is None for ref in refs):
+            continue
+        try:
+            title = json.loads(value).get('title')
+        except (ValueError, AttributeError):
+            continue
+        lat, lng = coordinate_key(key)
+        index_place('place_info', key, title, lat, lng, updated_at=timestamp)
+
+    click.echo(
+        f"Импортировано записей: {written_total} из {total} "
+        f"(остальные не новее имеющихся; {backend.name}, {time.monotonic() - started:.1f} с).",
+        err=True
+    )
+
+
+def init_app(app):
+    """Регистрирует команды `flask cache-export` и `flask cache-import`."""
+    app.cli.add_command(cache_export_command)
+    app.cli.add_command(cache_import_command)
@@ -5,14 +5,17 @@ import click
 import json
 import datetime
 import sys
+import threading
+import time
 from flask import current_app, g
 
 # --- Управление Соединением с БД ---
 
-def get_db():
+def get_db(upgrade=True):
     """
     Возвращает соединение с БД для текущего запроса.
-    Создает новое соединение, если его еще нет.
+    Создает новое соединение, если его еще нет; при первом соединении с базой
+    в процессе догоняет изменения схемы (upgrade=False - без этого, для init-db).
     """
     if 'db' not in g:
         try:
@@ -23,6 +26,8 @@ def get_db():
             # Возвращать строки как объекты, к которым можно обращаться по имени колонки
             g.db.row_factory = sqlite3.Row
             print("Соединение с БД установлено.")
+            if upgrade:
+                _upgrade_once(g.db, current_app.config['DATABASE'])
         except sqlite3.Error as e:
             print(f"ОШИБКА: Не удалось подключиться к базе данных {current_app.config['DATABASE']}: {e}", file=sys.stderr)
             # В реальном приложении здесь может быть более сложная обработка ошибок
@@ -41,11 +46,14 @@ def close_db(e=None):
 def init_db():
     """Удаляет существующие данные и создает новые таблицы на основе schema.sql."""
     try:
-        db = get_db()
+        # Схема пересоздается целиком, догонять старую не нужно
+        db = get_db(upgrade=False)
         # Получаем путь к файлу schema.sql из папки приложения
         with current_app.open_resource('schema.sql') as f:
             # Выполняем все SQL команды из файла
             db.executescript(f.read().decode('utf8'))
+        with _upgrade_lock:
+            _upgraded_databases.add(current_app.config['DATABASE'])
         print("База данных успешно инициализирована схемой из schema.sql.")
     except FileNotFoundError:
          print("ОШИБКА: Файл schema.sql не найден в корневой папке приложения.", file=sys.stderr)
@@ -62,6 +70,74 @@ def init_db():
              print(f"Не удалось проверить существующие таблицы: {check_e}", file=sys.stderr)
              raise e # Повторно вызываем исходную ошибку
 
+# Идемпотентные изменения схемы для уже существующих баз (init-db их пересоздает
+# из schema.sql, а эти выражения догоняют старые базы при первом соединении).
+_SCHEMA_UPGRADES = [
+    """CREATE TABLE IF NOT EXISTS places_index (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        ref TEXT NOT NULL,
+        title TEXT NOT NULL,
+        latitude REAL NOT NULL,
+        longitude REAL NOT NULL,
+        updated_at TEXT NOT NULL,
+        UNIQUE (source, ref)
+    )""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS places_rtree USING rtree(
+        id, min_lat, max_lat, min_lng, max_lng
+    )""",
+    "ALTER TABLE users ADD COLUMN last_login_at TEXT",
+    """CREATE TABLE IF NOT EXISTS recommendations (
+        fingerprint TEXT PRIMARY KEY,
+        json_result TEXT NOT NULL,
+        model TEXT,
+        generated_at TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_users_last_login ON users (last_login_at)",
+    "CREATE INDEX IF NOT EXISTS idx_visited_places_visited_at ON visited_places (visited_at)",
+]
+
+_upgraded_databases = set()
+_upgrade_lock = threading.Lock()
+
+def schema_exists(db):
+    """Есть ли в базе основные таблицы (пустой файл базы их не содержит)."""
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users'").fetchone() is not None
+
+def upgrade_db(db=None):
+    """Применяет недостающие изменения схемы к существующей базе.
+
+    База без основных таблиц не трогается - ее создает init_db. Изменения
+    применяются в одной транзакции, чтобы ошибка не оставила базу наполовину обновленной.
+    """
+    db = db or get_db(upgrade=False)
+    if not schema_exists(db):
+        print("Схема БД не создана, обновление пропущено (нужен `flask init-db`).", file=sys.stderr)
+        return False
+    try:
+        db.execute('BEGIN')
+        for statement in _SCHEMA_UPGRADES:
+            try:
+                db.execute(statement)
+            except sqlite3.OperationalError as e:
+                # ADD COLUMN не поддерживает IF NOT EXISTS
+                if 'duplicate column name' not in str(e):
+                    raise
+        db.commit()
+    except sqlite3.Error as e:
+        db.rollback()
+        print(f"ОШИБКА при обновлении схемы БД: {e}", file=sys.stderr)
+        raise
+    return True
+
+def _upgrade_once(db, path):
+    """Обновляет схему базы один раз за процесс."""
+    with _upgrade_lock:
+        if path in _upgraded_databases:
+            return
+        if upgrade_db(db):
+            _upgraded_databases.add(path)
+
 @click.command('init-db')
 def init_db_command():
     """Flask CLI команда для инициализации базы данных."""
@@ -88,27 +164,24 @@ def init_app(app):
 
 # --- Функции Кэширования ---
 
-def get_cached_place_info(lat, lng, max_age_seconds=3600 * 6): # Кэш на 6 часов по умолчанию
-    """Извлекает кэшированную информацию о месте, если она существует и не устарела."""
-    db = get_db()
-    # Создаем стабильный ключ кэша с фиксированной точностью координат
-    cache_key = f"{lat:.6f}_{lng:.6f}"
+def place_cache_key(lat, lng):
+    """Стабильный ключ кэша с фиксированной точностью координат."""
+    return f"{lat:.6f}_{lng:.6f}"
+
+def get_cached_json(cache_key, max_age_seconds):
+    """Извлекает JSON из бэкенда кэша (current_app.cache_backend), если он не устарел."""
+    backend = current_app.cache_backend
     try:
-        cursor = db.execute(
-            'SELECT json_result, timestamp FROM cache WHERE cache_key = ?', (cache_key,)
-        )
-        row = cursor.fetchone()
-        if row:
-            cached_time = datetime.datetime.fromisoformat(row['timestamp'])
+        entry = backend.get(cache_key)
+        if entry:
+            json_result, timestamp = entry
+            cached_time = datetime.datetime.fromisoformat(timestamp)
             # Используем UTC для сравнения времени
             if datetime.datetime.now(datetime.timezone.utc) - cached_time < datetime.timedelta(seconds=max_age_seconds):
                 print(f"Кэш HIT для ключа: {cache_key}")
-                return json.loads(row['json_result']) # Возвращаем распарсенный JSON
+                return json.loads(json_result) # Возвращаем распарсенный JSON
             else:
                 print(f"Кэш STALE для ключа: {cache_key}")
-                # Можно добавить удаление устаревшей записи здесь:
-                # db.execute('DELETE FROM cache WHERE cache_key = ?', (cache_key,))
-                # db.commit()
         else:
             print(f"Кэш MISS для ключа: {cache_key}")
     except sqlite3.Error as e:
@@ -117,31 +190,92 @@ def get_cached_place_info(lat, lng, max_age_seconds=3600 * 6): # Кэш на 6 
         print(f"Ошибка декодирования JSON из кэша для ключа {cache_key}: {e}", file=sys.stderr)
         # Возможно, стоит удалить поврежденную запись?
     except Exception as e:
-        print(f"Неожиданная ошибка при чтении кэша для ключа {cache_key}: {e}", file=sys.stderr)
+        print(f"Неожиданная ошибка при чтении кэша ({backend.name}) для ключа {cache_key}: {e}", file=sys.stderr)
     return None # Возвращаем None в случае ошибки или отсутствия/устаревания кэша
 
+def cache_json(cache_key, json_result, ttl=None):
+    """Сохраняет JSON-совместимое значение в бэкенд кэша.
+
+    ttl ограничивает хранение в бэкендах с собственным сроком жизни (redis);
+    по умолчанию - CACHE_DEFAULT_TTL.
+    """
+    backend = current_app.cache_backend
+    try:
+        # Используем UTC время для временной метки
+        timestamp_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        backend.set(cache_key, json.dumps(json_result), timestamp_iso, ttl)
+        print(f"Результат для ключа {cache_key} успешно закэширован.")
+    except sqlite3.Error as e:
+        print(f"SQLite ошибка при записи в кэш для ключа {cache_key}: {e}", file=sys.stderr)
+    except Exception as e:
+        print(f"Неожиданная ошибка при записи в кэш ({backend.name}) для ключа {cache_key}: {e}", file=sys.stderr)
+
+def get_cached_place_info(lat, lng, max_age_seconds=3600 * 6): # Кэш на 6 часов по умолчанию
+    """Извлекает кэшированную информацию о месте, если она существует и не устарела."""
+    return get_cached_json(place_cache_key(lat, lng), max_age_seconds)
+
 def cache_place_info(lat, lng, json_result):
     """Сохраняет информацию о месте в кэш."""
     if not isinstance(json_result, (dict, list)): # Проверяем базовую валидность данных
         print(f"Попытка кэшировать невалидные данные (не dict/list) для {lat},{lng}. Пропуск.", file=sys.stderr)
         return
+    cache_json(place_cache_key(lat, lng), json_result)
+
+
+# --- Пространственный индекс известных мест ---
+
+def index_place(source, ref, title, lat, lng, updated_at=None):
+    """Добавляет или обновляет место в пространственном индексе (places_index + R*Tree).
 
+    updated_at (ISO) по умолчанию - текущее время; при импорте кэша передается время записи.
+    """
+    if not title or lat is None or lng is None:
+        return
     db = get_db()
-    cache_key = f"{lat:.6f}_{lng:.6f}"
     try:
-        # Используем UTC время для временной метки
-        timestamp_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
-        db.execute(
-            # INSERT OR REPLACE атомарно заменит запись, если ключ уже существует
-            'INSERT OR REPLACE INTO cache (cache_key, json_result, timestamp) VALUES (?, ?, ?)',
-            (cache_key, json.dumps(json_result), timestamp_iso)
-        )
-        db.commit() # Подтверждаем транзакцию
-        print(f"Результат для ключа {cache_key} успешно закэширован.")
+        updated_at = updated_at or datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with db:
+            db.execute(
+                """
+                INSERT INTO places_index (source, ref, title, latitude, longitude, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source, ref) DO UPDATE SET
+                    title = excluded.title, latitude = excluded.latitude,
+                    longitude = excluded.longitude, updated_at = excluded.updated_at
+                """,
+                (source, ref, title, lat, lng, updated_at)
+            )
+            place_id = db.execute(
+                'SELECT id FROM places_index WHERE source = ? AND ref = ?', (source, ref)
+            ).fetchone()['id']
+            db.execute(
+                'INSERT OR REPLACE INTO places_rtree (id, min_lat, max_lat, min_lng, max_lng) VALUES (?, ?, ?, ?, ?)',
+                (place_id, lat, lat, lng, lng)
+            )
     except sqlite3.Error as e:
-        print(f"SQLite ошибка при записи в кэш для ключа {cache_key}: {e}", file=sys.stderr)
-    except Exception as e:
-        print(f"Неожиданная ошибка при записи в кэш для ключа {cache_key}: {e}", file=sys.stderr)
+        print(f"Ошибка SQLite при индексации места {source}:{ref}: {e}", file=sys.stderr)
+
+def find_indexed_places(south, west, north, east, place_info_since, limit):
+    """Возвращает места из индекса внутри прямоугольника.
+
+    Записи place_info старше place_info_since (ISO) пропускаются: их кэш уже мог истечь.
+    """
+    db = get_db()
+    try:
+        return db.execute(
+            """
+            SELECT p.source, p.ref, p.title, p.latitude, p.longitude
+            FROM places_rtree r
+            JOIN places_index p ON p.id = r.id
+            WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lng >= ? AND r.max_lng <= ?
+              AND (p.source != 'place_info' OR p.updated_at >= ?)
+            LIMIT ?
+            """,
+            (south, north, west, east, place_info_since, limit)
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Ошибка SQLite при поиске мест в области: {e}", file=sys.stderr)
+        return []
 
 
 # --- Функции для Пользователей ---
@@ -170,6 +304,81 @@ def get_user_by_username(username):
         print(f"Ошибка SQLite при поиске пользователя по имени '{username}': {e}", file=sys.stderr)
         return None
 
+# Короткоживущий кэш пользователей в памяти процесса: позволяет не ходить в БД
+# на каждом запросе (в том числе на JSON API) ради загрузки g.user.
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+def get_cached_user(user_id, ttl_seconds):
+    """Возвращает {'id', 'username'} пользователя из кэша или из БД (None, если не найден)."""
+    now = time.monotonic()
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry and entry[0] > now:
+            return entry[1]
+
+    db = get_db()
+    row = db.execute(
+        'SELECT id, username FROM users WHERE id = ?', (user_id,)
+    ).fetchone()
+    if row is None:
+        invalidate_cached_user(user_id)
+        return None
+
+    user = {'id': row['id'], 'username': row['username']}
+    if ttl_seconds > 0:
+        with _user_cache_lock:
+            _user_cache[user_id] = (now + ttl_seconds, user)
+    return user
+
+def invalidate_cached_user(user_id):
+    """Удаляет пользователя из кэша (выход, изменение данных)."""
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+def update_user_password_hash(user_id, password_hash):
+    """Заменяет хеш пароля пользователя (например, при смене параметров хеширования)."""
+    db = get_db()
+    try:
+        db.execute(
+            "UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id)
+        )
+        db.commit()
+        invalidate_cached_user(user_id)
+        return True
+    except sqlite3.Error as e:
+        print(f"Ошибка SQLite при обновлении хеша пароля пользователя {user_id}: {e}", file=sys.stderr)
+        return False
+
+def record_login(user_id):
+    """Запоминает время последнего входа пользователя (для пакетных заданий)."""
+    db = get_db()
+    try:
+        db.execute(
+            'UPDATE users SET last_login_at = ? WHERE id = ?',
+            (datetime.datetime.now(datetime.timezone.utc).isoformat(), user_id)
+        )
+        db.commit()
+    except sqlite3.Error as e:
+        print(f"Ошибка SQLite при записи времени входа пользователя {user_id}: {e}", file=sys.stderr)
+
+def get_active_user_ids(since_iso):
+    """ID пользователей, которые входили или отмечали места начиная с since_iso."""
+    db = get_db()
+    try:
+        rows = db.execute(
+            """
+            SELECT id FROM users WHERE last_login_at >= ?
+            UNION
+            SELECT DISTINCT user_id FROM visited_places WHERE visited_at >= ?
+            """,
+            (since_iso, since_iso)
+        ).fetchall()
+        return [row[0] for row in rows]
+    except sqlite3.Error as e:
+        print(f"Ошибка SQLite при выборке активных пользователей: {e}", file=sys.stderr)
+        return []
+
 def add_user(username, password_hash):
     """Добавляет нового пользователя в БД. Пароль должен быть уже хеширован."""
     db = get_db()
@@ -320,3 +529,41 @@ def get_user_interests(user_id):
     except Exception as e:
         print(f"Неожиданная ошибка при получении имен интересов для пользователя {user_id}: {e}", file=sys.stderr)
         return []
+
+
+# --- Хранилище предвычисленных рекомендаций ---
+
+def get_stored_recommendations(fingerprint, max_age_seconds):
+    """Возвращает рекомендации для отпечатка профиля, если они не устарели."""
+    db = get_db()
+    try:
+        row = db.execute(
+            'SELECT json_result, generated_at FROM recommendations WHERE fingerprint = ?',
+            (fingerprint,)
+        ).fetchone()
+        if row is None:
+            return None
+        generated_at = datetime.datetime.fromisoformat(row['generated_at'])
+        if datetime.datetime.now(datetime.timezone.utc) - generated_at >= datetime.timedelta(seconds=max_age_seconds):
+            return None
+        return json.loads(row['json_result'])
+    except (sqlite3.Error, json.JSONDecodeError) as e:
+        print(f"Ошибка при чтении рекомендаций {fingerprint[:12]}: {e}", file=sys.stderr)
+        return None
+
+def store_recommendations(fingerprint, recommendations, model=None):
+    """Сохраняет рекомендации для отпечатка профиля."""
+    db = get_db()
+    try:
+        db.execute(
+            """
+            INSERT INTO recommendations (fingerprint, json_result, model, generated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (fingerprint) DO UPDATE SET
+                json_result = excluded.json_result, model = excluded.model, generated_at = excluded.generated_at
+            """,
+            (fingerprint, json.dumps(recommendations, ensure_ascii=False), model,
+             datetime.datetime.now(datetime.timezone.utc).isoformat())
+        )
+        db.commit()
+    except sqlite3.Error as e:
+        print(f"Ошибка SQLite при сохранении рекомендаций {fingerprint[:12]}: {e}", file=sys.stderr)
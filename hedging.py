@@ -0,0 +1,159 @@
+# hedging.py
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Хеджированные запросы к внешним сервисам для борьбы с хвостом задержек.
+# Первая попытка запускается сразу; если она не завершилась за "хедж-задержку"
+# (p95 недавних задержек этого сервиса), параллельно запускается следующая
+# попытка (к тому же или альтернативному провайдеру). Берется первый успешный
+# результат; опоздавшие попытки дорабатывают в фоне, их результат отбрасывается.
+
+
+class HedgeTimeout(TimeoutError):
+    """Ни одна попытка не завершилась успешно до дедлайна."""
+
+
+class LatencyTracker:
+    """Скользящее окно задержек по имени сервиса."""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, name, fraction, min_samples=20):
+        """Возвращает перцентиль задержки или None, если данных мало."""
+        with self._lock:
+            samples = sorted(self._samples.get(name, ()))
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+latency_tracker = LatencyTracker()
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(pool_size):
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='hedge')
+            _executor_pid = os.getpid()
+    return _executor
+
+
+def hedge_delay(name, default_delay, min_delay, max_delay):
+    """Задержка перед хедж-попыткой: p95 недавних задержек в заданных пределах."""
+    p95 = latency_tracker.percentile(name, 0.95)
+    delay = default_delay if p95 is None else p95
+    return max(min_delay, min(delay, max_delay))
+
+
+def default_retryable(error):
+    """Ошибка, после которой имеет смысл сразу отправить хедж-запрос.
+
+    Таймауты, сетевые ошибки и ответы 5xx - да; 429 (квота) и прочие 4xx - нет:
+    повторный идентичный запрос только удвоит расход квоты.
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, 'code', None)
+    return isinstance(code, int) and 500 <= code < 600
+
+
+class _Attempt:
+    """Попытка хеджированного вызова; задержка учитывается в статистике один раз."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self._recorded = False
+        self._lock = threading.Lock()
+
+    def record(self, now=None):
+        with self._lock:
+            if self._recorded:
+                return
+            self._recorded = True
+        latency_tracker.record(self.name, (now or time.monotonic()) - self.started)
+
+
+def hedged_call(name, attempts, deadline, delay, pool_size=32, retryable=default_retryable):
+    """Выполняет попытки с хеджированием.
+
+    attempts - список функций без аргументов (основная попытка первой).
+    Следующая попытка запускается через delay после предыдущей или сразу после
+    ее ошибки, если retryable(error) истинно; неповторяемая ошибка пробрасывается
+    без хеджа. Возвращает (результат, индекс успешной попытки). Если все попытки
+    упали, пробрасывает последнюю ошибку; если истек дедлайн - HedgeTimeout.
+    """
+    executor = _get_executor(pool_size)
+    started = time.monotonic()
+    deadline_at = started + deadline
+    pending = {}
+    last_error = None
+    next_attempt = 0
+
+    def launch(index):
+        attempt = _Attempt(name)
+
+        def run():
+            result = attempts[index]()
+            # Успешные попытки учитываются всегда, даже завершившиеся после победителя
+            attempt.record()
+            return result
+
+        pending[executor.submit(run)] = (index, attempt)
+
+    launch(next_attempt)
+    next_attempt += 1
+
+    while pending:
+        now = time.monotonic()
+        if now >= deadline_at:
+            break
+        wait_until = deadline_at
+        if next_attempt < len(attempts):
+            # Следующая попытка стартует через delay после предыдущей
+            wait_until = min(deadline_at, started + delay * next_attempt)
+        done, _ = wait(pending, timeout=max(0.0, wait_until - now), return_when=FIRST_COMPLETED)
+
+        for future in done:
+            index, _ = pending.pop(future)
+            error = future.exception()
+            if error is None:
+                for other in pending:
+                    other.cancel()
+                return future.result(), index
+            if not retryable(error):
+                for other in pending:
+                    other.cancel()
+                raise error
+            last_error = error
+
+        if next_attempt < len(attempts) and (not pending or time.monotonic() >= started + delay * next_attempt):
+            # Хедж по таймеру или сразу после повторяемой ошибки предыдущей попытки
+            launch(next_attempt)
+            next_attempt += 1
+
+    now = time.monotonic()
+    for future, (_, attempt) in pending.items():
+        # Не уложившаяся в дедлайн попытка учитывается хотя бы временем до дедлайна,
+        # иначе p95 смещается вниз
+        attempt.record(now)
+        future.cancel()
+    if pending or last_error is None:
+        raise HedgeTimeout(f"{name}: нет ответа за {deadline:.1f} с")
+    raise last_error
@@ -0,0 +1,87 @@
+# http_cache.py
+
+import gzip
+from flask import current_app, jsonify, request
+
+try:
+    import brotli  # Необязательная зависимость: без нее используется только gzip
+except ImportError:
+    brotli = None
+
+# HTTP-кэширование ответов: ETag по хешу содержимого с ответом 304,
+# заголовки Cache-Control и сжатие крупных ответов gzip/brotli.
+
+# Тяжелые поля информации о месте, которые в облегченном режиме не отдаются
+HEAVY_PLACE_FIELDS = ('web_results', 'wikipedia_summary')
+
+
+def parse_include(value):
+    """Разбирает параметр include ('a,b' или список) в множество имен полей."""
+    if not value:
+        return set()
+    if isinstance(value, str):
+        value = value.split(',')
+    return {str(field).strip() for field in value if str(field).strip()}
+
+
+def slim_payload(payload, include=None, heavy_fields=HEAVY_PLACE_FIELDS):
+    """Возвращает копию словаря без тяжелых полей, кроме явно запрошенных."""
+    include = include or set()
+    return {
+        key: value for key, value in payload.items()
+        if key not in heavy_fields or key in include
+    }
+
+
+def cacheable_json(payload, max_age=None, private=False):
+    """JSON-ответ с ETag по содержимому; для GET/HEAD отвечает 304 при совпадении."""
+    response = jsonify(payload)
+    response.add_etag()
+    if max_age is not None and request.method in ('GET', 'HEAD'):
+        if private:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+def compress_response(response):
+    """Сжимает ответ gzip/brotli, если клиент это поддерживает и ответ достаточно велик."""
+    config = current_app.config
+    if (
+        not config['COMPRESS_ENABLED']
+        or response.direct_passthrough
+        or response.status_code != 200
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in config['COMPRESS_MIMETYPES']
+    ):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    accept_encodings = request.accept_encodings
+    if brotli is not None and accept_encodings['br']:
+        encoding = 'br'
+        data = brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY'])
+    elif accept_encodings['gzip']:
+        encoding = 'gzip'
+        data = gzip.compress(data, compresslevel=config['COMPRESS_GZIP_LEVEL'])
+    else:
+        return response
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    # Сжатое представление отличается побайтно, поэтому ETag становится слабым
+    etag, is_weak = response.get_etag()
+    if etag and not is_weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    """Регистрирует сжатие ответов в приложении."""
+    app.after_request(compress_response)
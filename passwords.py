@@ -0,0 +1,130 @@
+# passwords.py
+
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+)
+
+# Хеширование паролей намеренно медленное (scrypt/PBKDF2), поэтому выполняется
+# в отдельном ограниченном пуле процессов, а не в потоке WSGI-воркера.
+# Поток запроса лишь ждет результат и не держит GIL, так что всплеск логинов
+# ограничен размером пула и не съедает CPU у запросов к карте.
+
+_SCRYPT_DEFAULT_PARAMS = "32768:8:1"
+
+
+class PasswordHasherBusy(RuntimeError):
+    """Очередь на хеширование переполнена или ожидание превысило таймаут."""
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_pending = None
+
+
+def normalize_hash_method(method):
+    """Дополняет метод хеширования параметрами по умолчанию (как это делает werkzeug)."""
+    parts = method.split(':')
+    if parts[0] == 'scrypt' and len(parts) == 1:
+        return f"scrypt:{_SCRYPT_DEFAULT_PARAMS}"
+    if parts[0] == 'pbkdf2':
+        hash_name = parts[1] if len(parts) > 1 else 'sha256'
+        iterations = parts[2] if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    return method
+
+
+def _get_executor():
+    """Возвращает пул процессов, пересоздавая его после fork (например, в gunicorn)."""
+    global _executor, _executor_pid, _pending
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+    if workers <= 0:
+        return None
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            # 'spawn' безопаснее 'fork' в многопоточном процессе WSGI-сервера
+            _executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _executor_pid = os.getpid()
+            _pending = threading.BoundedSemaphore(
+                current_app.config['PASSWORD_HASH_MAX_PENDING']
+            )
+            print(f"Пул хеширования паролей запущен: {workers} процесс(ов).")
+    return _executor
+
+
+def _run(func, *args):
+    """Выполняет функцию в пуле с ограничением очереди и таймаутом ожидания результата."""
+    executor = _get_executor()
+    if executor is None:
+        return func(*args)
+
+    timeout = current_app.config['PASSWORD_HASH_TIMEOUT']
+    # Переполненная очередь - сразу отказ, поток запроса не ждет освобождения места
+    if not _pending.acquire(blocking=False):
+        raise PasswordHasherBusy("Очередь хеширования паролей переполнена.")
+    try:
+        future = executor.submit(func, *args)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise PasswordHasherBusy("Превышено время ожидания хеширования пароля.")
+        except BrokenProcessPool:
+            _discard_executor(executor)
+            raise PasswordHasherBusy("Пул хеширования паролей аварийно завершился.")
+    finally:
+        _pending.release()
+
+
+def _discard_executor(executor):
+    """Сбрасывает сломанный пул, чтобы следующий запрос создал новый."""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def hash_password(password):
+    """Хеширует пароль с текущими параметрами из конфигурации."""
+    return _run(
+        generate_password_hash,
+        password,
+        current_app.config['PASSWORD_HASH_METHOD'],
+        current_app.config['PASSWORD_HASH_SALT_LENGTH'],
+    )
+
+
+def verify_password(password_hash, password):
+    """Проверяет пароль по сохраненному хешу."""
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """Проверяет, отличаются ли параметры сохраненного хеша от текущих настроек."""
+    try:
+        method, salt, _ = password_hash.split('$', 2)
+    except ValueError:
+        return True
+    configured = normalize_hash_method(current_app.config['PASSWORD_HASH_METHOD'])
+    return (
+        method != configured
+        or len(salt) != current_app.config['PASSWORD_HASH_SALT_LENGTH']
+    )
+
+
+@atexit.register
+def _shutdown_executor():
+    if _executor is not None and _executor_pid == os.getpid():
+        _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,273 @@
+# profiling.py
+
+import contextlib
+import cProfile
+import datetime
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+import click
+from flask import current_app, g, has_request_context, request
+from flask.cli import with_appcontext
+
+# Профилирование запросов по требованию и запись медленных запросов.
+#
+# При PROFILING_ENABLED фоновый поток периодически снимает стеки потоков,
+# обрабатывающих запросы (sys._current_frames), и копит их в "свернутом" виде
+# (folded stacks: "a;b;c N"), совместимом с flamegraph.pl и speedscope.
+# Профиль сохраняется, если запрос попал в выборку (PROFILING_SAMPLE_RATE),
+# пришел с заголовком X-Profile или оказался медленнее PROFILING_SLOW_THRESHOLD_MS.
+# "X-Profile: cprofile" дополнительно включает cProfile для этого запроса.
+# Профили хранятся в кольцевом каталоге instance/profiles (не больше
+# PROFILING_RING_SIZE файлов); их просматривает команда `flask profiles`.
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN_HEADER = 'X-Profile-Token'
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Засекает длительность этапа обработки запроса (в g.stage_timings)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            g.setdefault('stage_timings', []).append(
+                [name, round((time.perf_counter() - started) * 1000, 2)]
+            )
+
+
+class _StackSampler:
+    """Фоновый семплер стеков для зарегистрированных потоков."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_running(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._thread = threading.Thread(target=self._run, name='profiling-sampler', daemon=True)
+        self._pid = os.getpid()
+        self._thread.start()
+
+    def register(self, thread_id):
+        counter = Counter()
+        with self._lock:
+            self._ensure_running()
+            self._active[thread_id] = counter
+        return counter
+
+    def unregister(self, thread_id):
+        with self._lock:
+            return self._active.pop(thread_id, None)
+
+    @staticmethod
+    def _fold(frame):
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(parts))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, counter in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        counter[self._fold(frame)] += 1
+
+
+def _profiles_dir():
+    return current_app.config['PROFILING_DIR'] or os.path.join(current_app.instance_path, 'profiles')
+
+
+def _trigger_from_request():
+    """Определяет, нужно ли сохранять профиль запроса и каким способом."""
+    config = current_app.config
+    header = request.headers.get(PROFILE_HEADER, '').lower()
+    if header and (
+        not config['PROFILING_TRIGGER_TOKEN']
+        or request.headers.get(PROFILE_TOKEN_HEADER) == config['PROFILING_TRIGGER_TOKEN']
+    ):
+        return 'header-cprofile' if header == 'cprofile' else 'header'
+    if random.random() < config['PROFILING_SAMPLE_RATE']:
+        return 'sampled'
+    return None
+
+
+def _start_profiling():
+    if request.endpoint == 'static':
+        return
+    g.profile_trigger = _trigger_from_request()
+    g.profile_started = time.perf_counter()
+    g.profile_stacks = current_app.extensions['profiling_sampler'].register(threading.get_ident())
+    if g.profile_trigger == 'header-cprofile':
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profile_cprofile = profiler
+        except ValueError:
+            # Начиная с Python 3.12 одновременно может работать только один cProfile
+            logging.warning("cProfile уже активен в другом запросе, остаются только семплы стеков.")
+
+
+def _finish_profiling(response):
+    if 'profile_started' not in g:
+        return response
+    duration_ms = (time.perf_counter() - g.profile_started) * 1000
+    current_app.extensions['profiling_sampler'].unregister(threading.get_ident())
+    cprofile_stats = None
+    profiler = g.pop('profile_cprofile', None)
+    if profiler is not None:
+        profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(40)
+        cprofile_stats = stream.getvalue()
+
+    trigger = g.profile_trigger
+    if trigger is None and duration_ms >= current_app.config['PROFILING_SLOW_THRESHOLD_MS']:
+        trigger = 'slow'
+    if trigger is None:
+        return response
+
+    try:
+        save_profile({
+            'id': f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}",
+            'ts': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round(duration_ms, 2),
+            'trigger': trigger,
+            'stages': g.get('stage_timings', []),
+            'samples': sum(g.profile_stacks.values()),
+            'folded': dict(g.profile_stacks),
+            'cprofile': cprofile_stats,
+        })
+    except OSError as e:
+        logging.error(f"Не удалось сохранить профиль запроса: {e}")
+    return response
+
+
+def _cleanup_profiling(exc=None):
+    # after_request не вызывается при необработанном исключении - снимаем регистрацию здесь
+    if 'profile_started' in g:
+        current_app.extensions['profiling_sampler'].unregister(threading.get_ident())
+        profiler = g.pop('profile_cprofile', None)
+        if profiler is not None:
+            profiler.disable()
+
+
+def save_profile(record):
+    """Сохраняет профиль в кольцевой каталог, удаляя самые старые записи."""
+    directory = _profiles_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{record['id']}.json")
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(record, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+    files = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+    for name in files[:-current_app.config['PROFILING_RING_SIZE']]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(directory, name))
+
+
+def load_profile(profile_id):
+    """Загружает профиль по id (или по уникальному префиксу id)."""
+    directory = _profiles_dir()
+    matches = [
+        name for name in os.listdir(directory)
+        if name.endswith('.json') and name.startswith(profile_id)
+    ] if os.path.isdir(directory) else []
+    if len(matches) != 1:
+        raise click.ClickException(
+            f"Профиль '{profile_id}' не найден." if not matches
+            else f"Префикс '{profile_id}' неоднозначен ({len(matches)} профилей)."
+        )
+    with open(os.path.join(directory, matches[0]), encoding='utf-8') as f:
+        return json.load(f)
+
+
+@click.group('profiles')
+def profiles_command():
+    """Просмотр сохраненных профилей запросов."""
+
+
+@profiles_command.command('list')
+@with_appcontext
+@click.option('--limit', default=20, show_default=True, help='Сколько последних профилей показать.')
+def list_profiles_command(limit):
+    """Список сохраненных профилей (новые сверху)."""
+    directory = _profiles_dir()
+    if not os.path.isdir(directory):
+        click.echo('Профилей нет.')
+        return
+    names = sorted((n for n in os.listdir(directory) if n.endswith('.json')), reverse=True)[:limit]
+    for name in names:
+        with open(os.path.join(directory, name), encoding='utf-8') as f:
+            record = json.load(f)
+        stages = ', '.join(f"{stage_name}={ms:.0f}ms" for stage_name, ms in record['stages'])
+        click.echo(
+            f"{record['id']}  {record['ts'][:19]}  {record['method']} {record['path']}  "
+            f"{record['status']}  {record['duration_ms']:.0f}ms  [{record['trigger']}]  {stages}"
+        )
+
+
+@profiles_command.command('export')
+@with_appcontext
+@click.argument('profile_id')
+@click.option('-o', '--output', type=click.File('w'), default='-',
+              help='Файл для свернутых стеков (по умолчанию stdout).')
+def export_profile_command(profile_id, output):
+    """Экспортирует стеки профиля в формате folded (flamegraph.pl, speedscope)."""
+    record = load_profile(profile_id)
+    for stack, count in sorted(record['folded'].items()):
+        output.write(f"{stack} {count}\n")
+
+
+@profiles_command.command('show')
+@with_appcontext
+@click.argument('profile_id')
+def show_profile_command(profile_id):
+    """Показывает этапы запроса и, если есть, статистику cProfile."""
+    record = load_profile(profile_id)
+    click.echo(f"{record['method']} {record['path']} -> {record['status']}, {record['duration_ms']:.1f} ms [{record['trigger']}]")
+    for stage_name, ms in record['stages']:
+        click.echo(f"  {stage_name:<24} {ms:>10.1f} ms")
+    click.echo(f"Семплов стека: {record['samples']}")
+    if record.get('cprofile'):
+        click.echo(record['cprofile'])
+
+
+def init_app(app):
+    """Подключает профилирование запросов и команду `flask profiles`."""
+    app.cli.add_command(profiles_command)
+    if not app.config['PROFILING_ENABLED']:
+        return
+    app.extensions['profiling_sampler'] = _StackSampler(app.config['PROFILING_SAMPLE_INTERVAL'])
+    app.before_request(_start_profiling)
+    app.after_request(_finish_profiling)
+    app.teardown_request(_cleanup_profiling)
+    logging.info("Профилирование запросов включено.")
@@ -0,0 +1,175 @@
+# recommendations.py
+
+import datetime
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import click
+from flask import current_app, g
+from flask.cli import with_appcontext
+from google.api_core.exceptions import ResourceExhausted
+from database import (
+    get_active_user_ids, get_stored_recommendations, get_user_interests,
+    get_visited_places, store_recommendations
+)
+
+# Предвычисление рекомендаций: `flask precompute-recommendations`.
+#
+# Рекомендации зависят только от интересов и недавних мест пользователя, поэтому
+# хранятся по отпечатку этого профиля (таблица recommendations): пользователи с
+# одинаковым профилем делят одну генерацию, а маршрут /get-recommendations
+# сначала читает готовый ответ по первичному ключу. Задание обходит активных
+# пользователей (вход или отметка места за последние --active-days дней) и
+# генерирует только отсутствующие или устаревшие отпечатки - изменившийся
+# профиль дает новый отпечаток. Вызовы LLM идут с ограниченным параллелизмом и
+# темпом; при исчерпании квоты (429) задание отступает и может остановиться,
+# следующий запуск продолжит с оставшихся профилей.
+
+VISITED_IN_PROMPT = 10
+
+
+def summarize_visited(visited):
+    """Краткое описание недавних мест для промпта (и для отпечатка профиля)."""
+    return [
+        f"'{place['place_name'] or 'Unknown'}' ({place['latitude']:.3f},{place['longitude']:.3f})"
+        for place in visited[:VISITED_IN_PROMPT]
+    ]
+
+
+def recommendations_fingerprint(interests, visited_summary):
+    """Отпечаток профиля: совпадает, только если совпадает промпт рекомендаций."""
+    payload = json.dumps([sorted(interests), visited_summary], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def user_profile(user_id):
+    """Возвращает (interests, visited_summary, fingerprint) пользователя."""
+    interests = get_user_interests(user_id)
+    visited_summary = summarize_visited(get_visited_places(user_id))
+    return interests, visited_summary, recommendations_fingerprint(interests, visited_summary)
+
+
+class _RateLimiter:
+    """Не чаще rate_per_minute запусков; пауза после отказа по квоте действует на всех."""
+
+    def __init__(self, rate_per_minute):
+        self.interval = 60.0 / rate_per_minute if rate_per_minute else 0.0
+        self._next_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self._next_at - now)
+            self._next_at = max(now, self._next_at) + self.interval
+        if delay:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._next_at = max(self._next_at, time.monotonic() + seconds)
+
+
+def _generate(app, generate, interests, visited_summary, limiter, max_retries, backoff):
+    """Генерация в отдельном потоке со своим контекстом приложения."""
+    with app.app_context():
+        for attempt in range(max_retries + 1):
+            limiter.wait()
+            try:
+                result = generate(interests, visited_summary)
+                return result, (g.get('ai_served') or {}).get('model')
+            except ResourceExhausted:
+                if attempt == max_retries:
+                    raise
+                delay = backoff * (2 ** attempt)
+                logging.warning(f"Квота LLM исчерпана, пауза {delay:.0f} с.")
+                limiter.pause(delay)
+
+
+@click.command('precompute-recommendations')
+@with_appcontext
+@click.option('--active-days', type=int, help='Окно активности пользователей (по умолчанию RECOMMENDATIONS_ACTIVE_DAYS).')
+@click.option('--concurrency', type=int, help='Параллельных вызовов LLM (по умолчанию RECOMMENDATIONS_BATCH_CONCURRENCY).')
+@click.option('--rate', type=float, help='Не больше N вызовов LLM в минуту (по умолчанию RECOMMENDATIONS_BATCH_RATE).')
+@click.option('--limit', type=int, help='Не больше N генераций за запуск (бюджет квоты).')
+@click.option('--force', is_flag=True, help='Пересчитать и свежие рекомендации.')
+def precompute_recommendations_command(active_days, concurrency, rate, limit, force):
+    """Предвычисляет рекомендации для активных пользователей с изменившимся профилем."""
+    app = current_app._get_current_object()
+    config = app.config
+    generate = app.extensions['recommendations_generator']
+    active_days = active_days or config['RECOMMENDATIONS_ACTIVE_DAYS']
+    concurrency = concurrency or config['RECOMMENDATIONS_BATCH_CONCURRENCY']
+    limiter = _RateLimiter(rate if rate is not None else config['RECOMMENDATIONS_BATCH_RATE'])
+    since = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=active_days)).isoformat()
+
+    # Группируем активных пользователей по отпечатку профиля
+    profiles = {}
+    user_ids = get_active_user_ids(since)
+    for user_id in user_ids:
+        interests, visited_summary, fingerprint = user_profile(user_id)
+        profiles.setdefault(fingerprint, (interests, visited_summary, []))[2].append(user_id)
+
+    pending = [
+        (fingerprint, interests, visited_summary)
+        for fingerprint, (interests, visited_summary, _) in profiles.items()
+        if force or get_stored_recommendations(fingerprint, config['RECOMMENDATIONS_MAX_AGE']) is None
+    ]
+    if limit is not None:
+        pending = pending[:limit]
+    click.echo(
+        f"Активных пользователей: {len(user_ids)}, профилей: {len(profiles)}, "
+        f"к генерации: {len(pending)}."
+    )
+
+    generated = failed = 0
+    quota_exhausted = False
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='recommendations') as executor:
+        queue = iter(pending)
+        running = {}
+
+        def submit_next():
+            item = next(queue, None)
+            if item is not None:
+                fingerprint, interests, visited_summary = item
+                running[executor.submit(
+                    _generate, app, generate, interests, visited_summary, limiter,
+                    config['RECOMMENDATIONS_QUOTA_RETRIES'], config['RECOMMENDATIONS_QUOTA_BACKOFF']
+                )] = fingerprint
+
+        for _ in range(concurrency):
+            submit_next()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                fingerprint = running.pop(future)
+                try:
+                    result, model = future.result()
+                    store_recommendations(fingerprint, result, model)
+                    generated += 1
+                except ResourceExhausted:
+                    failed += 1
+                    quota_exhausted = True
+                except Exception as e:
+                    failed += 1
+                    logging.error(f"Не удалось сгенерировать рекомендации {fingerprint[:12]}: {type(e).__name__}: {e}")
+                if not quota_exhausted:
+                    submit_next()
+
+    click.echo(f"Сгенерировано: {generated}, ошибок: {failed}, за {time.monotonic() - started:.1f} с.")
+    if quota_exhausted:
+        click.echo("Квота LLM исчерпана - оставшиеся профили будут обработаны следующим запуском.", err=True)
+
+
+def init_app(app, generate):
+    """Регистрирует команду пакетного расчета.
+
+    generate(interests, visited_summary) возвращает список рекомендаций;
+    передается из app.py, чтобы не импортировать его отсюда.
+    """
+    app.extensions['recommendations_generator'] = generate
+    app.cli.add_command(precompute_recommendations_command)
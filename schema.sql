@@ -5,17 +5,39 @@ DROP TABLE IF EXISTS user_interests;
 DROP TABLE IF EXISTS interests;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS cache;
+DROP TABLE IF EXISTS places_rtree;
+DROP TABLE IF EXISTS places_index;
+DROP TABLE IF EXISTS recommendations;
 
-CREATE TABLE cache (...); -- Полное определение
+CREATE TABLE cache (
+  cache_key TEXT PRIMARY KEY,
+  json_result TEXT NOT NULL,
+  timestamp TEXT NOT NULL
+);
 CREATE INDEX idx_cache_timestamp ON cache (timestamp);
 
+-- Пространственный индекс уже известных мест (для /places/in-viewport)
+CREATE TABLE places_index (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  source TEXT NOT NULL,
+  ref TEXT NOT NULL,
+  title TEXT NOT NULL,
+  latitude REAL NOT NULL,
+  longitude REAL NOT NULL,
+  updated_at TEXT NOT NULL,
+  UNIQUE (source, ref)
+);
+CREATE VIRTUAL TABLE places_rtree USING rtree(id, min_lat, max_lat, min_lng, max_lng);
+
 CREATE TABLE users (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   username TEXT UNIQUE NOT NULL,
   password_hash TEXT NOT NULL,
-  created_at TEXT DEFAULT CURRENT_TIMESTAMP
+  created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+  last_login_at TEXT
 );
 CREATE UNIQUE INDEX idx_users_username ON users (username);
+CREATE INDEX idx_users_last_login ON users (last_login_at);
 
 CREATE TABLE interests (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -43,6 +65,15 @@ CREATE TABLE visited_places (
     FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
 );
 CREATE INDEX idx_visited_places_user ON visited_places (user_id);
+CREATE INDEX idx_visited_places_visited_at ON visited_places (visited_at);
+
+-- Рекомендации по отпечатку профиля (интересы + недавние места), см. recommendations.py
+CREATE TABLE recommendations (
+  fingerprint TEXT PRIMARY KEY,
+  json_result TEXT NOT NULL,
+  model TEXT,
+  generated_at TEXT NOT NULL
+);
 
 -- Предзаполнение интересов (опционально)
 INSERT INTO interests (name) VALUES ('History'), ('Architecture'), ('Nature'), ('Food'), ('Art'), ('Music'), ('Shopping'), ('Nightlife'), ('Adventure'), ('Relaxation'), ('Technology'), ('Local Culture'), ('Museums'), ('Parks');
\ No newline at end of file
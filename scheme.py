@@ -0,0 +1,197 @@
+# scheme.py
+
+import functools
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+
+# Построение Mermaid mind map для /generate-scheme.
+# Схема зависит только от полей места и набора интересов пользователя, поэтому
+# результат кэшируется по хешу содержимого; сами данные места запоминаются по
+# ключу, чтобы клиент мог запросить схему по ключу, не пересылая весь place_data.
+
+WIKI_NOT_FOUND_TEXT = "Соответствующая статья в Википедии не найдена."
+
+# Одна таблица преобразования вместо цепочки str.replace
+_MERMAID_TRANSLATION = str.maketrans({
+    '(': r'\(', ')': r'\)',
+    '{': r'\{', '}': r'\}',
+    '[': r'\[', ']': r'\]',
+    '"': '&quot;', '#': None,
+})
+
+# Поля place_data, от которых зависит схема (и ключ содержимого)
+_SCHEME_FIELDS = (
+    'title', 'description', 'details', 'sources', 'ai_confidence',
+    'wikipedia_summary', 'web_results',
+)
+
+
+class _LRUCache:
+    """Потокобезопасный LRU-кэш фиксированного размера."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+_place_store = _LRUCache(1024)
+_scheme_cache = _LRUCache(1024)
+
+
+def configure(place_store_size, scheme_cache_size):
+    """Задает размеры кэшей (вызывается из фабрики приложения)."""
+    _place_store.max_size = place_store_size
+    _scheme_cache.max_size = scheme_cache_size
+
+
+def sanitize_mermaid_text(text):
+    """Экранирует текст для Mermaid."""
+    if not isinstance(text, str):
+        text = str(text)
+    return text.translate(_MERMAID_TRANSLATION).strip()
+
+
+def scheme_place_fields(place_data):
+    """Оставляет только поля, нужные для построения схемы."""
+    return {field: place_data[field] for field in _SCHEME_FIELDS if field in place_data}
+
+
+def place_content_key(place_data):
+    """Стабильный хеш содержимого места (только поля, влияющие на схему)."""
+    canonical = json.dumps(
+        scheme_place_fields(place_data), sort_keys=True, ensure_ascii=False,
+        separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+
+
+def remember_place(place_data):
+    """Запоминает данные места для схемы и возвращает ключ для клиента."""
+    key = place_content_key(place_data)
+    if _place_store.get(key) is None:
+        _place_store.set(key, scheme_place_fields(place_data))
+    return key
+
+
+def get_remembered_place(place_key):
+    """Возвращает запомненные данные места по ключу или None."""
+    return _place_store.get(place_key)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_interest_matcher(lowered_interests):
+    """Компилирует одно регулярное выражение для поиска всех интересов в тексте."""
+    # Длинные варианты первыми, а lookahead позволяет находить пересекающиеся вхождения
+    alternatives = sorted(set(lowered_interests), key=len, reverse=True)
+    return re.compile('(?=(' + '|'.join(map(re.escape, alternatives)) + '))')
+
+
+def find_related_interests(text_lower, interests):
+    """Возвращает интересы (в исходном порядке), встречающиеся в тексте."""
+    lowered = tuple(interest.lower() for interest in interests if interest)
+    if not lowered:
+        return []
+    found = set(_compile_interest_matcher(lowered).findall(text_lower))
+    related = []
+    for interest, interest_lower in zip((i for i in interests if i), lowered):
+        # Короткий интерес мог совпасть в той же позиции, что и более длинный
+        if interest_lower in found or any(interest_lower in match for match in found):
+            related.append(interest)
+    return related
+
+
+def _source_line(source):
+    if source.startswith(('http://', 'https://')):
+        domain_parts = source.split('/')
+        domain = domain_parts[2] if len(domain_parts) > 2 else source
+        safe_source_url = source.replace('"', '&quot;')
+        return f'      > <a href="{safe_source_url}" target="_blank">{sanitize_mermaid_text(domain)}</a>'
+    return f"      > {sanitize_mermaid_text(source[:60])}..."
+
+
+def render_mindmap(place_data, interests):
+    """Строит текст Mermaid mind map (без кэширования)."""
+    title = place_data.get('title', 'Местоположение')
+    description = place_data.get('description', '')
+    details = place_data.get('details', [])
+    sources = place_data.get('sources', [])
+    confidence = place_data.get('ai_confidence', 'Неизвестно')
+    wiki_summary = place_data.get('wikipedia_summary', '')
+    web_results = place_data.get('web_results', [])
+
+    lines = [
+        "mindmap",
+        f"  root(({sanitize_mermaid_text(title)}))",
+        f"    (AI Confidence: {sanitize_mermaid_text(confidence)})",
+    ]
+    if description:
+        lines.append(f"    (Desc: {sanitize_mermaid_text(description[:80])}...)")
+
+    if details:
+        lines.append("    ::icon(fa fa-list-ul) Key Details")
+        lines.extend(
+            f"      - {sanitize_mermaid_text(detail[:100])}"
+            for detail in details if isinstance(detail, str) and detail.strip()
+        )
+
+    if wiki_summary and wiki_summary != WIKI_NOT_FOUND_TEXT:
+        lines.append("    ::icon(fa fa-wikipedia-w) Wikipedia Summary")
+        lines.append(f"      ... {sanitize_mermaid_text(wiki_summary[:150])} ...")
+
+    if web_results:
+        lines.append("    ::icon(fa fa-globe) Web Results")
+        lines.extend(
+            f"      > {sanitize_mermaid_text(result.get('title', 'No title')[:60])}..."
+            for result in web_results[:3]
+        )
+
+    combined_text_lower = " ".join(
+        (description, " ".join(map(str, details)), wiki_summary)
+    ).lower()
+    related_interests = find_related_interests(combined_text_lower, interests)
+    if related_interests:
+        lines.append("    ::icon(fa fa-star) Related User Interests")
+        lines.extend(
+            f"      * {sanitize_mermaid_text(interest.capitalize())}"
+            for interest in related_interests
+        )
+
+    valid_sources = [s for s in sources if isinstance(s, str) and s.strip() and s != 'N/A']
+    if valid_sources:
+        lines.append("    ::icon(fa fa-link) Sources")
+        lines.extend(_source_line(source) for source in valid_sources)
+
+    return "\n".join(lines).strip()
+
+
+def build_mindmap(place_data, interests, place_key=None):
+    """Возвращает Mermaid mind map, используя кэш по содержимому и набору интересов."""
+    if place_key is None:
+        place_key = place_content_key(place_data)
+    cache_key = (place_key, tuple(sorted(interest.lower() for interest in interests)))
+
+    mermaid_string = _scheme_cache.get(cache_key)
+    if mermaid_string is None:
+        mermaid_string = render_mindmap(place_data, interests)
+        _scheme_cache.set(cache_key, mermaid_string)
+    return mermaid_string
@@ -0,0 +1,131 @@
+# test_cache_backends.py
+
+import fnmatch
+import multiprocessing
+import socketserver
+import threading
+import pytest
+from cache_backends import CacheBackendError, MmapCacheBackend, RedisCacheBackend
+
+TS_OLD = '2024-01-01T00:00:00+00:00'
+TS_NEW = '2024-01-02T00:00:00+00:00'
+
+
+# --- Локальная замена Redis: минимальный RESP-сервер ---
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    """GET/SET [EX]/DEL/MGET/SCAN; SCAN отдает ключи страницами по SCAN_PAGE."""
+
+    SCAN_PAGE = 2
+
+    def _bulk(self, value):
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def handle(self):
+        store, ttls = self.server.store, self.server.ttls
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:-2])):
+                length = int(self.rfile.readline()[1:-2])
+                args.append(self.rfile.read(length + 2)[:-2])
+            command = args[0].upper()
+            if command == b'SET':
+                store[args[1]] = args[2]
+                ttls[args[1]] = int(args[4]) if len(args) > 4 and args[3].upper() == b'EX' else None
+                reply = b"+OK\r\n"
+            elif command == b'GET':
+                reply = self._bulk(store.get(args[1]))
+            elif command == b'DEL':
+                reply = b":%d\r\n" % (store.pop(args[1], None) is not None)
+            elif command == b'MGET':
+                reply = b"*%d\r\n" % (len(args) - 1) + b"".join(self._bulk(store.get(key)) for key in args[1:])
+            elif command == b'SCAN':
+                keys = sorted(key for key in store if fnmatch.fnmatchcase(key.decode(), args[3].decode()))
+                start = int(args[1])
+                page = keys[start:start + self.SCAN_PAGE]
+                cursor = start + self.SCAN_PAGE if start + self.SCAN_PAGE < len(keys) else 0
+                reply = (b"*2\r\n" + self._bulk(str(cursor).encode()) + b"*%d\r\n" % len(page)
+                         + b"".join(self._bulk(key) for key in page))
+            else:
+                reply = b"-ERR unknown command\r\n"
+            self.wfile.write(reply)
+
+
+@pytest.fixture
+def resp_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _RespHandler)
+    server.daemon_threads = True
+    server.store, server.ttls = {}, {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def redis_backend(resp_server):
+    return RedisCacheBackend(f"redis://127.0.0.1:{resp_server.server_address[1]}/0", 'test:', 3600, 5)
+
+
+def test_redis_get_set_delete(redis_backend):
+    assert redis_backend.get('missing') is None
+    redis_backend.set('key', '{"a": 1}', TS_OLD)
+    assert redis_backend.get('key') == ('{"a": 1}', TS_OLD)
+    redis_backend.delete('key')
+    assert redis_backend.get('key') is None
+
+
+def test_redis_set_uses_ttl_or_default(redis_backend, resp_server):
+    redis_backend.set('short', '1', TS_OLD, ttl=60)
+    redis_backend.set('default', '2', TS_OLD)
+    assert resp_server.ttls[b'test:short'] == 60
+    assert resp_server.ttls[b'test:default'] == 3600
+
+
+def test_redis_items_follows_scan_cursor(redis_backend, resp_server):
+    for index in range(5):
+        redis_backend.set(f"key{index}", str(index), TS_OLD)
+    resp_server.store[b'other:key'] = b"ignored"
+    assert sorted(redis_backend.items()) == [(f"key{index}", str(index), TS_OLD) for index in range(5)]
+
+
+def test_redis_merge_keeps_newer(redis_backend):
+    redis_backend.set('key', 'new', TS_NEW)
+    written = redis_backend.merge([('key', 'old', TS_OLD), ('fresh', 'value', TS_OLD)])
+    assert written == [('fresh', 'value', TS_OLD)]
+    assert redis_backend.get('key') == ('new', TS_NEW)
+
+
+# --- mmap: общий файл для нескольких процессов ---
+
+def _mmap_child(path, queue):
+    backend = MmapCacheBackend(path, 64, 512)
+    backend.set('from_child', 'child value', TS_OLD)
+    queue.put(backend.get('from_parent'))
+
+
+def test_mmap_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'cache.mmap')
+    backend = MmapCacheBackend(path, 64, 512)
+    backend.set('from_parent', 'parent value', TS_NEW)
+
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_mmap_child, args=(path, queue))
+    process.start()
+    from_parent = queue.get(timeout=30)
+    process.join(timeout=30)
+
+    assert process.exitcode == 0
+    assert from_parent == ('parent value', TS_NEW)
+    assert backend.get('from_child') == ('child value', TS_OLD)
+
+
+def test_mmap_rejects_other_geometry(tmp_path):
+    path = str(tmp_path / 'cache.mmap')
+    MmapCacheBackend(path, 64, 512).set('key', 'value', TS_OLD)
+    with pytest.raises(CacheBackendError):
+        MmapCacheBackend(path, 32, 512).get('key')
@@ -0,0 +1,413 @@
+# traffic.py
+
+import datetime
+import functools
+import glob
+import hashlib
+import hmac
+import http.cookiejar
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app, g, request
+from flask.cli import with_appcontext
+from database import get_all_interests, get_user_interests
+
+# Запись продакшн-трафика и его детерминированное воспроизведение.
+#
+# При TRAFFIC_CAPTURE_ENABLED каждый (семплированный) запрос пишется одной
+# JSON-строкой в ротируемый файл: маршрут, координаты, профиль пользователя
+# (отсортированные названия интересов из общего справочника и их хеш, без id
+# и имени), время ответа и статус кэша.
+# При TRAFFIC_CAPTURE_UPSTREAMS туда же пишутся ответы внешних сервисов
+# (Nominatim, Википедия, DuckDuckGo, Gemini), а UPSTREAM_STUB_PATH позволяет
+# запустить приложение, отвечающее вместо них записанными данными. Если точного
+# ответа нет, UPSTREAM_STUB_FALLBACK подставляет последний ответ того же вида
+# вызова (для Gemini - того же формата ответа), а не любой ответ сервиса.
+#
+# Команда `flask replay-traffic` прогоняет записанный трафик против работающего
+# приложения со скоростью 1x, Nx или максимально возможной. Запросы вошедших
+# пользователей идут от синтетических пользователей replay-<отпечаток> с теми
+# же интересами, чтобы ключи кэша и промпты совпадали с продакшном.
+
+# Параметры запроса, которые безопасно сохранять (никаких паролей и т.п.)
+_CAPTURED_PARAMS = ('lat', 'lng', 'view', 'include', 'place_key')
+
+_capture_loggers = {}
+_capture_lock = threading.Lock()
+
+
+class UpstreamStubMiss(LookupError):
+    """В записанном трафике нет ответа для вызова внешнего сервиса."""
+
+
+def _json_default(value):
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    return str(value)
+
+
+def _capture_logger():
+    """Возвращает логгер записи трафика для текущего процесса (свой файл на воркер)."""
+    pid = os.getpid()
+    with _capture_lock:
+        logger = _capture_loggers.get(pid)
+        if logger is None:
+            directory = current_app.config['TRAFFIC_CAPTURE_DIR'] or os.path.join(
+                current_app.instance_path, 'traffic'
+            )
+            os.makedirs(directory, exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                os.path.join(directory, f"traffic-{pid}.jsonl"),
+                maxBytes=current_app.config['TRAFFIC_CAPTURE_MAX_BYTES'],
+                backupCount=current_app.config['TRAFFIC_CAPTURE_BACKUP_COUNT'],
+                encoding='utf-8',
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger = logging.getLogger(f"traffic_capture.{pid}")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            _capture_loggers[pid] = logger
+    return logger
+
+
+def _write_record(record):
+    _capture_logger().info(json.dumps(record, ensure_ascii=False, default=_json_default))
+
+
+def profile_fingerprint(interests):
+    """Обезличенный отпечаток профиля: хеш отсортированного набора интересов."""
+    if not interests:
+        return None
+    joined = ','.join(sorted({interest.lower() for interest in interests}))
+    return hashlib.sha256(joined.encode('utf-8')).hexdigest()[:16]
+
+
+def _request_params():
+    params = dict(request.args)
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            params.update(body)
+    return {key: params[key] for key in _CAPTURED_PARAMS if key in params}
+
+
+def _normalize_arg(value):
+    # 2 и 2.0 (JSON против query-параметров) должны давать один ключ
+    if isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _upstream_key(name, args, kwargs):
+    args = [_normalize_arg(arg) for arg in args]
+    kwargs = {key: _normalize_arg(value) for key, value in kwargs.items()}
+    payload = json.dumps([name, args, kwargs], sort_keys=True, default=_json_default)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _variant_key(name, variant, args, kwargs):
+    if variant is None:
+        return None
+    payload = json.dumps(variant(*args, **kwargs), sort_keys=True, default=_json_default)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def recorded_upstream(name, variant=None):
+    """Декоратор для вызовов внешних сервисов: запись ответов и подмена записанными.
+
+    variant(*args, **kwargs) - вид вызова (например, ожидаемый формат ответа);
+    запасной ответ при UPSTREAM_STUB_FALLBACK берется только того же вида.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stubs = current_app.extensions.get('upstream_stubs')
+            capture = (
+                current_app.config['TRAFFIC_CAPTURE_ENABLED']
+                and current_app.config['TRAFFIC_CAPTURE_UPSTREAMS']
+                and g.get('traffic_capture')
+            )
+            if stubs is None and not capture:
+                return func(*args, **kwargs)
+
+            key = _upstream_key(name, args, kwargs)
+            kind = _variant_key(name, variant, args, kwargs)
+            if stubs is not None:
+                if (name, key) in stubs['exact']:
+                    return stubs['exact'][(name, key)]
+                if current_app.config['UPSTREAM_STUB_FALLBACK'] and (name, kind) in stubs['latest']:
+                    return stubs['latest'][(name, kind)]
+                if current_app.config['UPSTREAM_STUB_STRICT']:
+                    raise UpstreamStubMiss(f"Нет записанного ответа {name} для ключа {key[:12]}")
+
+            result = func(*args, **kwargs)
+            if capture:
+                _write_record({'type': 'upstream', 'name': name, 'key': key, 'variant': kind, 'result': result})
+            return result
+        return wrapper
+    return decorator
+
+
+def load_upstream_stubs(paths):
+    """Загружает записанные ответы внешних сервисов из файлов захвата."""
+    exact, latest = {}, {}
+    for record in iter_capture_records(paths):
+        if record.get('type') != 'upstream':
+            continue
+        result = record['result']
+        # JSON превращает кортежи в списки; вызывающий код распаковывает их одинаково
+        exact[(record['name'], record['key'])] = result
+        latest[(record['name'], record.get('variant'))] = result
+    print(f"Загружено записанных ответов внешних сервисов: {len(exact)}")
+    return {'exact': exact, 'latest': latest}
+
+
+def iter_capture_records(paths):
+    """Читает записи из файлов захвата (поддерживаются glob-шаблоны и каталоги)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, 'traffic-*.jsonl*'))))
+        else:
+            files.extend(sorted(glob.glob(path)) or [path])
+    for file_path in files:
+        with open(file_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"Пропущена поврежденная строка в {file_path}")
+
+
+def _start_capture():
+    g.traffic_capture = random.random() < current_app.config['TRAFFIC_CAPTURE_SAMPLE_RATE']
+    g.traffic_started = time.perf_counter()
+
+
+def _finish_capture(response):
+    if not g.get('traffic_capture') or request.endpoint == 'static':
+        return response
+    try:
+        interests = None
+        if g.get('user'):
+            interests = g.get('interests')
+            if interests is None:
+                interests = get_user_interests(g.user['id'])
+        params = _request_params()
+        _write_record({
+            'type': 'request',
+            'ts': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'method': request.method,
+            'route': request.url_rule.rule if request.url_rule else request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - g.traffic_started) * 1000, 2),
+            'lat': _as_float(params.pop('lat', None)),
+            'lng': _as_float(params.pop('lng', None)),
+            'params': params,
+            'user': profile_fingerprint(interests),
+            # Названия из общего справочника интересов, не персональные данные
+            'interests': sorted({interest.lower() for interest in interests}) if interests else None,
+            'class': g.get('request_class'),
+            'cache': g.get('cache_status'),
+            'ai_tier': g.get('ai_served', {}).get('tier'),
+            'bytes': response.calculate_content_length(),
+        })
+    except Exception as e:
+        logging.error(f"Ошибка записи трафика: {e}")
+    return response
+
+
+def init_app(app):
+    """Подключает запись трафика, подмену внешних сервисов и команду replay-traffic."""
+    if app.config['TRAFFIC_CAPTURE_ENABLED']:
+        app.before_request(_start_capture)
+        app.after_request(_finish_capture)
+        logging.info("Запись трафика включена.")
+    if app.config['UPSTREAM_STUB_PATH']:
+        app.extensions['upstream_stubs'] = load_upstream_stubs([app.config['UPSTREAM_STUB_PATH']])
+        logging.warning("Внешние сервисы подменены записанными ответами.")
+    app.cli.add_command(replay_traffic_command)
+
+
+# --- Воспроизведение трафика ---
+
+def _build_request(record, target):
+    params = dict(record.get('params') or {})
+    if record.get('lat') is not None:
+        params['lat'] = record['lat']
+        params['lng'] = record['lng']
+    url = target.rstrip('/') + record['route']
+    if record['method'] == 'GET':
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        return urllib.request.Request(url, method='GET')
+    return urllib.request.Request(
+        url, method=record['method'], data=json.dumps(params).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+
+
+def _replay_password(fingerprint):
+    return hmac.new(
+        current_app.config['SECRET_KEY'].encode('utf-8'), fingerprint.encode('utf-8'), hashlib.sha256
+    ).hexdigest()
+
+
+def _login_synthetic_user(target, interests, interest_ids, timeout):
+    """Входит синтетическим пользователем с заданными интересами; возвращает opener с сессией."""
+    fingerprint = profile_fingerprint(interests)
+    credentials = {'username': f"replay-{fingerprint}", 'password': _replay_password(fingerprint)}
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    base = target.rstrip('/')
+
+    def post(path, fields):
+        data = urllib.parse.urlencode(fields, doseq=True).encode('utf-8')
+        with opener.open(urllib.request.Request(base + path, data=data, method='POST'), timeout=timeout) as response:
+            response.read()
+            return response.geturl()
+
+    # Повторная регистрация того же пользователя просто отклоняется приложением
+    post('/auth/register', credentials)
+    post('/auth/login', credentials)
+    # Без сессии /auth/profile перенаправляет на страницу входа
+    if not post('/auth/profile', {'interest_ids': interest_ids}).endswith('/auth/profile'):
+        raise click.ClickException(f"Не удалось войти синтетическим пользователем {credentials['username']}.")
+    return opener
+
+
+def _replay_sessions(records, target, timeout):
+    """Сессии синтетических пользователей по отпечаткам профилей из записи."""
+    ids_by_name = {row['name'].lower(): row['id'] for row in get_all_interests()}
+    sessions = {}
+    for record in records:
+        interests = record.get('interests')
+        fingerprint = profile_fingerprint(interests)
+        if fingerprint is None or fingerprint in sessions:
+            continue
+        unknown = [name for name in interests if name not in ids_by_name]
+        if unknown:
+            click.echo(f"Интересы не найдены в справочнике и пропущены: {', '.join(unknown)}", err=True)
+        interest_ids = [ids_by_name[name] for name in interests if name in ids_by_name]
+        sessions[fingerprint] = _login_synthetic_user(target, interests, interest_ids, timeout)
+    return sessions
+
+
+def _send(req, timeout, opener=None):
+    started = time.perf_counter()
+    try:
+        with (opener.open if opener else urllib.request.urlopen)(req, timeout=timeout) as response:
+            response.read()
+            status, cache = response.status, response.headers.get('X-Cache')
+    except urllib.error.HTTPError as e:
+        status, cache = e.code, e.headers.get('X-Cache')
+    except (urllib.error.URLError, OSError) as e:
+        status, cache = f"error:{type(e).__name__}", None
+    return status, cache, (time.perf_counter() - started) * 1000
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _parse_speed(ctx, param, value):
+    if value == 'max':
+        return None
+    try:
+        speed = float(value)
+    except ValueError:
+        raise click.BadParameter("ожидается число или 'max'")
+    if speed <= 0:
+        raise click.BadParameter("должна быть больше 0")
+    return speed
+
+
+@click.command('replay-traffic')
+@with_appcontext
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--target', default='http://127.0.0.1:5000', show_default=True,
+              help='Адрес работающего приложения.')
+@click.option('--speed', default='1', show_default=True, callback=_parse_speed,
+              help="Скорость: 1 - как в записи, N - в N раз быстрее, 'max' - без пауз.")
+@click.option('--concurrency', default=8, show_default=True, help='Максимум одновременных запросов.')
+@click.option('--limit', default=0, help='Воспроизвести не больше N запросов (0 - все).')
+@click.option('--route', 'routes', multiple=True, help='Воспроизводить только эти маршруты.')
+@click.option('--timeout', default=60.0, show_default=True, help='Таймаут одного запроса, сек.')
+def replay_traffic_command(paths, target, speed, concurrency, limit, routes, timeout):
+    """Воспроизводит записанный трафик против работающего приложения."""
+    records = [
+        r for r in iter_capture_records(paths)
+        if r.get('type') == 'request'
+        # Формы входа/регистрации записываются без учетных данных, их не повторяем
+        and not (r.get('endpoint', '').startswith('auth.') and r.get('method') == 'POST')
+        and r.get('endpoint') != 'static'
+        and (not routes or r.get('route') in routes)
+    ]
+    records.sort(key=lambda r: r['ts'])
+    if limit:
+        records = records[:limit]
+    if not records:
+        click.echo('Нет запросов для воспроизведения.')
+        return
+
+    sessions = _replay_sessions(records, target, timeout)
+    anonymous = sum(1 for r in records if r.get('user') and not r.get('interests'))
+    if anonymous:
+        # Записи до появления поля interests: профиль восстановить нельзя
+        click.echo(f"Запросов вошедших пользователей без списка интересов (пойдут анонимно): {anonymous}", err=True)
+    base_ts = datetime.datetime.fromisoformat(records[0]['ts'])
+    click.echo(
+        f"Воспроизведение {len(records)} запросов на {target} "
+        f"(скорость: {'max' if speed is None else f'{speed:g}x'}, синтетических пользователей: {len(sessions)})..."
+    )
+
+    results = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = []
+        for record in records:
+            if speed:
+                offset = (datetime.datetime.fromisoformat(record['ts']) - base_ts).total_seconds()
+                delay = offset / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            opener = sessions.get(profile_fingerprint(record.get('interests')))
+            futures.append(pool.submit(_send, _build_request(record, target), timeout, opener))
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for _, _, latency in results)
+    statuses = Counter(str(status) for status, _, _ in results)
+    cache_statuses = Counter(cache or '-' for _, cache, _ in results)
+    click.echo(f"Готово за {elapsed:.1f} с ({len(results) / elapsed:.1f} запр/с).")
+    click.echo(f"Статусы: {dict(statuses)}")
+    click.echo(f"Кэш (X-Cache): {dict(cache_statuses)}")
+    click.echo(
+        f"Задержка, мс: p50={_percentile(latencies, 0.5):.1f} "
+        f"p95={_percentile(latencies, 0.95):.1f} p99={_percentile(latencies, 0.99):.1f} "
+        f"max={latencies[-1]:.1f}"
+    )
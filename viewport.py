@@ -0,0 +1,185 @@
+# viewport.py
+
+import datetime
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from database import find_indexed_places
+
+# "Что есть рядом": уже известные места в видимой области карты.
+# Данные берутся только из пространственного индекса (places_index + R*Tree):
+# закэшированные описания мест, POI от геокодера и статьи Википедии.
+# LLM здесь не вызывается никогда. Ответ собирается из тайлов (z/x/y, как у
+# тайлов карты), каждый тайл кластеризуется по сетке и кэшируется в памяти.
+
+MAX_LATITUDE = 85.05112878  # Граница проекции Web Mercator
+
+
+class ViewportError(ValueError):
+    """Некорректные параметры области просмотра."""
+
+
+_tile_cache = OrderedDict()
+_tile_cache_lock = threading.Lock()
+_index_version = 0
+
+
+def invalidate_tiles(points):
+    """Удаляет из кэша текущего процесса тайлы всех масштабов, содержащие точки (lat, lng).
+
+    Вызывается после добавления мест в индекс; остальные тайлы остаются в кэше.
+    """
+    global _index_version
+    max_zoom = current_app.config['VIEWPORT_MAX_ZOOM']
+    keys = set()
+    for lat, lng in points:
+        for zoom in range(max_zoom + 1):
+            last = (1 << zoom) - 1
+            keys.add((zoom, min(_tile_x(lng, zoom), last), min(_tile_y(lat, zoom), last)))
+    with _tile_cache_lock:
+        # Тайлы, которые строятся прямо сейчас, могли не увидеть новые места - их не кэшируем
+        _index_version += 1
+        for key in keys:
+            _tile_cache.pop(key, None)
+
+
+def parse_bbox(value):
+    """Разбирает 'south,west,north,east' в кортеж чисел."""
+    try:
+        south, west, north, east = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        raise ViewportError("bbox должен иметь вид south,west,north,east")
+    if not (-90 <= south <= north <= 90) or not (-180 <= west <= 180 and -180 <= east <= 180):
+        raise ViewportError("bbox выходит за допустимые границы координат")
+    return south, west, north, east
+
+
+def _tile_x(lng, zoom):
+    return int((lng + 180.0) / 360.0 * (1 << zoom))
+
+
+def _tile_y(lat, zoom):
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    lat_rad = math.radians(lat)
+    return int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * (1 << zoom))
+
+
+def _tile_lng(x, zoom):
+    return x / (1 << zoom) * 360.0 - 180.0
+
+
+def _tile_lat(y, zoom):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / (1 << zoom)))))
+
+
+def tile_bounds(x, y, zoom):
+    """Границы тайла: (south, west, north, east)."""
+    return _tile_lat(y + 1, zoom), _tile_lng(x, zoom), _tile_lat(y, zoom), _tile_lng(x + 1, zoom)
+
+
+def tiles_for_bbox(south, west, north, east, zoom):
+    """Список (x, y) тайлов, покрывающих область (с учетом перехода через 180-й меридиан)."""
+    last = (1 << zoom) - 1
+    y_range = range(min(_tile_y(north, zoom), last), min(_tile_y(south, zoom), last) + 1)
+    if west <= east:
+        x_spans = [(west, east)]
+    else:
+        x_spans = [(west, 180.0), (-180.0, east)]
+    tiles = []
+    for span_west, span_east in x_spans:
+        for x in range(min(_tile_x(span_west, zoom), last), min(_tile_x(span_east, zoom), last) + 1):
+            tiles.extend((x, y) for y in y_range)
+    return tiles
+
+
+def _place_item(row):
+    return {
+        'type': 'place',
+        'source': row['source'],
+        'title': row['title'],
+        'lat': row['latitude'],
+        'lng': row['longitude'],
+    }
+
+
+def cluster_tile(rows, bounds, grid_size):
+    """Группирует места тайла по сетке grid_size x grid_size."""
+    south, west, north, east = bounds
+    cells = {}
+    for row in rows:
+        cell_x = min(grid_size - 1, int((row['longitude'] - west) / (east - west) * grid_size))
+        cell_y = min(grid_size - 1, int((row['latitude'] - south) / (north - south) * grid_size))
+        cells.setdefault((cell_x, cell_y), []).append(row)
+
+    items = []
+    for members in cells.values():
+        if len(members) == 1:
+            items.append(_place_item(members[0]))
+            continue
+        lats = [m['latitude'] for m in members]
+        lngs = [m['longitude'] for m in members]
+        items.append({
+            'type': 'cluster',
+            'count': len(members),
+            'lat': sum(lats) / len(lats),
+            'lng': sum(lngs) / len(lngs),
+            'bbox': [min(lats), min(lngs), max(lats), max(lngs)],
+        })
+    return items
+
+
+def _load_tile(x, y, zoom):
+    config = current_app.config
+    bounds = tile_bounds(x, y, zoom)
+    place_info_since = (
+        datetime.datetime.now(datetime.timezone.utc)
+        - datetime.timedelta(seconds=config['VIEWPORT_PLACE_INFO_MAX_AGE'])
+    ).isoformat()
+    rows = find_indexed_places(*bounds, place_info_since, config['VIEWPORT_TILE_MAX_PLACES'])
+    if zoom >= config['VIEWPORT_CLUSTER_MAX_ZOOM']:
+        return [_place_item(row) for row in rows]
+    return cluster_tile(rows, bounds, config['VIEWPORT_CLUSTER_GRID'])
+
+
+def get_tile(x, y, zoom):
+    """Возвращает элементы тайла из кэша или строит их по индексу."""
+    key = (zoom, x, y)
+    now = time.monotonic()
+    with _tile_cache_lock:
+        entry = _tile_cache.get(key)
+        if entry and entry[0] > now:
+            _tile_cache.move_to_end(key)
+            return entry[1]
+        version = _index_version
+
+    items = _load_tile(x, y, zoom)
+
+    with _tile_cache_lock:
+        # Индекс мог измениться, пока тайл строился, - такой результат не кэшируем
+        if version == _index_version:
+            _tile_cache[key] = (now + current_app.config['VIEWPORT_TILE_TTL'], items)
+            _tile_cache.move_to_end(key)
+            while len(_tile_cache) > current_app.config['VIEWPORT_TILE_CACHE_SIZE']:
+                _tile_cache.popitem(last=False)
+    return items
+
+
+def places_in_viewport(bbox, zoom):
+    """Собирает кластеры и места для области просмотра из тайлов."""
+    config = current_app.config
+    south, west, north, east = bbox
+    zoom = max(0, min(int(zoom), config['VIEWPORT_MAX_ZOOM']))
+    tiles = tiles_for_bbox(south, west, north, east, zoom)
+    # Слишком крупная область для этого масштаба - укрупняем тайлы
+    while len(tiles) > config['VIEWPORT_MAX_TILES'] and zoom > 0:
+        zoom -= 1
+        tiles = tiles_for_bbox(south, west, north, east, zoom)
+
+    def inside(item):
+        in_lng = west <= item['lng'] <= east if west <= east else (item['lng'] >= west or item['lng'] <= east)
+        return south <= item['lat'] <= north and in_lng
+
+    items = [item for x, y in tiles for item in get_tile(x, y, zoom) if inside(item)]
+    return {'zoom': zoom, 'tiles': len(tiles), 'items': items}